@@ -0,0 +1,115 @@
+import queue
+import threading
+import time
+from collections import deque
+from typing import Callable, Optional
+
+import requests
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """Raised instead of calling an endpoint whose circuit is open."""
+
+
+class EndpointHealth:
+    def __init__(self, name: str, failure_threshold: int = 5, cooldown: float = 30, window: int = 100, min_samples: int = 20) -> None:
+        """
+        Initialize the latency and failure tracking of an endpoint, with a circuit breaker.
+
+        After failure_threshold consecutive failures the circuit opens and calls fail fast for cooldown seconds. Then a
+        single trial call is let through, which closes the circuit on success or opens it again on failure.
+
+        :param name: Name of the endpoint, for error messages
+        :param failure_threshold: Consecutive failures that open the circuit. 0 disables the breaker.
+        :param cooldown: Seconds the circuit stays open
+        :param window: Number of recent latencies kept for percentiles
+        :param min_samples: Latencies needed before percentiles are reported
+        """
+        self._name = name
+        self._failure_threshold = failure_threshold
+        self._cooldown = cooldown
+        self._min_samples = min_samples
+        self._latencies: deque[float] = deque(maxlen=window)
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def check(self) -> None:
+        """
+        Check that the endpoint may be called.
+
+        :return: None
+        :raises: CircuitOpenError if the circuit is open, or a trial call is already in flight
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if not self._trial and time.monotonic() - self._opened_at >= self._cooldown:
+                self._trial = True
+                return
+            raise CircuitOpenError(f"Circuit open for Firefly {self._name} after {self._failures} failures")
+
+    def record(self, latency: float, ok: bool) -> None:
+        """
+        Record the outcome of a call.
+
+        :param latency: Seconds the call took
+        :param ok: Whether the call succeeded. Timeouts, connection errors and 5xx responses are failures.
+        :return: None
+        """
+        with self._lock:
+            self._trial = False
+            if ok:
+                self._latencies.append(latency)
+                self._failures = 0
+                self._opened_at = None
+                return
+            self._failures += 1
+            if self._failure_threshold and self._failures >= self._failure_threshold:
+                self._opened_at = time.monotonic()
+
+    def percentile(self, p: float) -> Optional[float]:
+        """
+        Get a percentile of the recent successful latencies.
+
+        :param p: The percentile, between 0 and 100
+        :return: The latency in seconds, or None if there are not enough samples yet
+        """
+        with self._lock:
+            if len(self._latencies) < self._min_samples:
+                return None
+            latencies = sorted(self._latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))]
+
+
+def hedge(send: Callable[[], requests.Response], delay: float) -> requests.Response:
+    """
+    Send an idempotent request, and a duplicate if the first one has not answered after delay.
+
+    The requests run on daemon threads, so a losing request does not hold up the interpreter exiting.
+
+    :param send: Function sending the request
+    :param delay: Seconds to wait before sending the duplicate, e.g. the p95 latency
+    :return: The first successful response
+    :raises: The exception of the last request to fail, if all fail
+    """
+    results: queue.Queue = queue.Queue()
+
+    def run() -> None:
+        try:
+            results.put((send(), None))
+        except Exception as e:
+            results.put((None, e))
+
+    threading.Thread(target=run, daemon=True).start()
+    try:
+        res, err = results.get(timeout=delay)
+    except queue.Empty:
+        threading.Thread(target=run, daemon=True).start()
+        res, err = results.get()
+        if err is not None:
+            res, err = results.get()
+    if err is not None:
+        raise err
+    return res
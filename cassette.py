@@ -0,0 +1,127 @@
+import base64
+import gzip
+import json
+import threading
+import time
+from collections import defaultdict, deque
+from urllib.parse import urlsplit
+
+import requests
+
+
+class Cassette:
+    def __init__(self, path: str, mode: str, latency_scale: float = 1.0) -> None:
+        """
+        Initialize a Cassette that records or replays all HTTP exchanges made through requests.
+
+        Both the Firefly API calls and the Splitwise SDK go through requests.Session.send, so installing the cassette
+        captures the whole run.
+
+        :param path: Path of the gzipped JSON lines cassette file
+        :param mode: "record" to capture a real run, "replay" to serve a captured run back
+        :param latency_scale: Multiplier for the recorded latencies on replay. 0 replays without delay.
+        """
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Cassette mode {mode} not implemented.")
+        self._path = path
+        self._mode = mode
+        self._latency_scale = latency_scale
+        self._lock = threading.Lock()
+        self._send = None
+        self._file = None
+        # Recorded exchanges, by exact request and by method and path for requests with volatile parameters (dates)
+        self._exact: dict[tuple, deque] = defaultdict(deque)
+        self._loose: dict[tuple, deque] = defaultdict(deque)
+
+    @staticmethod
+    def _keys(method: str, url: str, body) -> tuple[tuple, tuple]:
+        if isinstance(body, str):
+            body = body.encode()
+        parts = urlsplit(url)
+        return (method, url, body or b""), (method, parts.netloc + parts.path)
+
+    def install(self) -> "Cassette":
+        """
+        Patch requests.Session.send to record or replay exchanges.
+
+        :return: The cassette itself
+        """
+        if self._mode == "record":
+            self._file = gzip.open(self._path, "wt")
+        else:
+            with gzip.open(self._path, "rt") as f:
+                for line in f:
+                    entry = json.loads(line)
+                    entry["used"] = False
+                    exact, loose = self._keys(entry["method"], entry["url"], base64.b64decode(entry["body"]))
+                    self._exact[exact].append(entry)
+                    self._loose[loose].append(entry)
+
+        self._send = requests.Session.send
+        cassette = self
+
+        def send(session, request, **kwargs):
+            if cassette._mode == "record":
+                return cassette._record(session, request, **kwargs)
+            return cassette._replay(request)
+
+        requests.Session.send = send
+        return self
+
+    def uninstall(self) -> None:
+        """
+        Restore requests.Session.send and close the cassette file.
+
+        :return: None
+        """
+        if self._send:
+            requests.Session.send = self._send
+            self._send = None
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def _record(self, session, request, **kwargs) -> requests.Response:
+        start = time.perf_counter()
+        res = self._send(session, request, **kwargs)
+        elapsed = time.perf_counter() - start
+        body = request.body.encode() if isinstance(request.body, str) else request.body or b""
+        entry = {
+            "method": request.method,
+            "url": request.url,
+            "body": base64.b64encode(body).decode(),
+            "status": res.status_code,
+            "headers": {k: v for k, v in res.headers.items() if k.lower() in ("content-type", "etag", "last-modified")},
+            "content": base64.b64encode(res.content).decode(),
+            "elapsed": round(elapsed, 4),
+        }
+        with self._lock:
+            self._file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+        return res
+
+    def _take(self, queues: dict[tuple, deque], key: tuple):
+        queue = queues.get(key)
+        while queue:
+            entry = queue.popleft()
+            if not entry["used"]:
+                entry["used"] = True
+                return entry
+        return None
+
+    def _replay(self, request) -> requests.Response:
+        exact, loose = self._keys(request.method, request.url, request.body)
+        with self._lock:
+            entry = self._take(self._exact, exact) or self._take(self._loose, loose)
+        if entry is None:
+            raise requests.ConnectionError(f"No recorded response for {request.method} {request.url}", request=request)
+        if self._latency_scale:
+            time.sleep(entry["elapsed"] * self._latency_scale)
+
+        res = requests.Response()
+        res.status_code = entry["status"]
+        res.headers.update(entry["headers"])
+        res._content = base64.b64decode(entry["content"])
+        res.url = request.url
+        res.request = request
+        res.encoding = "utf-8"
+        return res
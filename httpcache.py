@@ -0,0 +1,128 @@
+import base64
+import hashlib
+import json
+import os
+import time
+from typing import Optional
+from urllib.parse import urlencode
+
+import requests
+
+
+class ResponseCache:
+    def __init__(self, directory: str, ttl: float = 0, scope: str = "") -> None:
+        """
+        Initialize an on-disk cache for GET responses.
+
+        Responses with an ETag or Last-Modified validator are revalidated with a conditional request, so an unchanged
+        resource costs a 304 without a body. Responses younger than the TTL are served without any request.
+
+        :param directory: Directory to store one JSON file per cached URL in
+        :param ttl: Seconds a cached response is served without revalidation. 0 always revalidates.
+        :param scope: Credentials the responses belong to, e.g. the API token. Part of every key, so another token
+            sharing the directory never sees them. Only a digest is kept.
+        """
+        self._directory = directory
+        self._ttl = ttl
+        self._scope = hashlib.sha256(scope.encode()).hexdigest()
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, url: str, params: dict) -> str:
+        """
+        Get the cache key of a request.
+
+        :param url: The request URL
+        :param params: A dictionary of query parameters
+        :return: A hex digest of the scope, URL and sorted parameters
+        """
+        query = urlencode(sorted((k, str(v)) for k, v in (params or {}).items()))
+        return hashlib.sha256(f"{self._scope} {url}?{query}".encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self._directory, f"{key}.json")
+
+    def get(self, key: str) -> Optional[dict]:
+        """
+        Get a cached entry.
+
+        :param key: The cache key
+        :return: The entry, or None if not cached or unreadable
+        """
+        try:
+            with open(self._path(key)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def is_fresh(self, entry: dict) -> bool:
+        """
+        Check whether an entry can be served without revalidation.
+
+        :param entry: A cached entry
+        :return: True if the entry is younger than the TTL
+        """
+        return time.time() - entry["stored_at"] < self._ttl
+
+    def validators(self, entry: dict) -> dict[str, str]:
+        """
+        Get the conditional request headers for an entry.
+
+        :param entry: A cached entry
+        :return: A dictionary of If-None-Match and If-Modified-Since headers, where the entry has validators
+        """
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def store(self, key: str, res: requests.Response) -> None:
+        """
+        Cache a successful response, if it has validators or a TTL is set.
+
+        :param key: The cache key
+        :param res: The response
+        :return: None
+        """
+        entry = {
+            "stored_at": time.time(),
+            "etag": res.headers.get("ETag"),
+            "last_modified": res.headers.get("Last-Modified"),
+            "content": base64.b64encode(res.content).decode(),
+        }
+        if not (entry["etag"] or entry["last_modified"] or self._ttl):
+            return
+        self._write(key, entry)
+
+    def touch(self, key: str, entry: dict) -> None:
+        """
+        Mark an entry as revalidated now.
+
+        :param key: The cache key
+        :param entry: The cached entry
+        :return: None
+        """
+        entry["stored_at"] = time.time()
+        self._write(key, entry)
+
+    def _write(self, key: str, entry: dict) -> None:
+        tmp = f"{self._path(key)}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp, self._path(key))
+
+    def response(self, entry: dict, url: str) -> requests.Response:
+        """
+        Build a response from a cached entry.
+
+        :param entry: A cached entry
+        :param url: The request URL
+        :return: A 200 response with the cached body
+        """
+        res = requests.Response()
+        res.status_code = 200
+        res._content = base64.b64decode(entry["content"])
+        res.url = url
+        res.encoding = "utf-8"
+        return res
@@ -0,0 +1,71 @@
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+
+# Attributes every LogRecord has, anything else was passed through extra
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "taskName"}
+
+
+class Lazy:
+    def __init__(self, fn, *args) -> None:
+        """
+        Initialize a log argument that is only computed if the message is emitted.
+
+        :param fn: Function returning the value to log
+        :param args: Arguments for fn
+        """
+        self._fn = fn
+        self._args = args
+
+    def __str__(self) -> str:
+        return str(self._fn(*self._args))
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        """
+        Format a record as a single line JSON object, including the fields passed through extra.
+
+        :param record: The log record
+        :return: A JSON string with time, level, logger, message and the extra fields
+        """
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update({k: v for k, v in vars(record).items() if k not in _RECORD_ATTRIBUTES})
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def setupLogging(level: str = "INFO", fmt: str = "text", stream=None) -> logging.handlers.QueueListener:
+    """
+    Configure the root logger to hand records to a background thread through a queue.
+
+    The calling thread only merges the message arguments and enqueues the record, writing to the stream happens on
+    the listener thread. Messages below the level are discarded before their arguments are formatted.
+
+    :param level: Name of the minimum level to log, e.g. DEBUG, INFO or WARNING
+    :param fmt: "text" for plain lines, "json" for one JSON object per line
+    :param stream: Stream to write to. If None, use stdout.
+    :return: The started listener. Stop it on exit to flush the queued records.
+    """
+    handler = logging.StreamHandler(stream or sys.stdout)
+    if fmt == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(message)s"))
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(level.upper())
+
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    return listener
@@ -1,14 +1,32 @@
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
 from splitwise import Splitwise, Expense, User, Comment
 from splitwise.user import ExpenseUser
-from typing import Generator, TypedDict, Union
+from typing import Callable, Generator, Optional, TypedDict, Union
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
 from typing import Union
 
+import argparse
+import atexit
+import copy
+import hashlib
+import json
+import logging
 import os
 import requests
-
+import threading
+import time
+
+from breaker import EndpointHealth, hedge
+from cassette import Cassette
+from httpcache import ResponseCache
+from logs import Lazy, setupLogging
+from pipeline import Pipeline
+from plan import PlanFile
+from splitwise_client import PooledSplitwise
+from spool import WriteSpool
+from profiling import Profiler
 from strategies.standard import StandardTransactionStrategy
 from strategies.sw_balance import SWBalanceTransactionStrategy
 from strategies.base import TransactionStrategy
@@ -20,10 +38,38 @@ class Config(TypedDict):
     FIREFLY_DEFAULT_CATEGORY: str
     FIREFLY_DEFAULT_SPEND_ACCOUNT: str
     FIREFLY_DEFAULT_TRXFR_ACCOUNT: str
+    FIREFLY_SEARCH_WORKERS: int
+    FIREFLY_CACHE_DIR: str
+    FIREFLY_CACHE_TTL: float
+    FIREFLY_SPOOL: str
+    FIREFLY_SPOOL_TIMEOUT: float
+    FIREFLY_TIMEOUT: float
+    FIREFLY_BREAKER_THRESHOLD: int
+    FIREFLY_BREAKER_COOLDOWN: float
+    FIREFLY_HEDGE_PERCENTILE: float
     SPLITWISE_TOKEN: str
     SPLITWISE_DAYS: int
+    SPLITWISE_COMMENT_CACHE: str
+    SPLITWISE_SHARD_WORKERS: int
+    SPLITWISE_POOL_SIZE: int
+    SPLITWISE_TIMEOUT: float
+    SPLITWISE_RETRIES: int
+    SPLITWISE_USER_CACHE: str
+    # Sync pipeline
+    SYNC_QUEUE_SIZE: int
+    SYNC_TRANSFORM_WORKERS: int
+    SYNC_WRITE_WORKERS: int
+    SYNC_BUDGET_SECONDS: float
+    SYNC_REMAINDER: str
+    # Logging
+    LOG_LEVEL: str
+    LOG_FORMAT: str
     # Debt tracker
     SW_BALANCE_ACCOUNT: str
+    # Record/replay of HTTP traffic
+    HTTP_CASSETTE: str
+    HTTP_CASSETTE_MODE: str
+    HTTP_CASSETTE_LATENCY_SCALE: float
 
 def load_config() -> Config:
     load_dotenv()
@@ -34,15 +80,63 @@ def load_config() -> Config:
         "FIREFLY_DEFAULT_CATEGORY": os.getenv("FIREFLY_DEFAULT_CATEGORY"),
         "FIREFLY_DEFAULT_SPEND_ACCOUNT": os.getenv("FIREFLY_DEFAULT_SPEND_ACCOUNT", "Amex"),
         "FIREFLY_DEFAULT_TRXFR_ACCOUNT": os.getenv("FIREFLY_DEFAULT_TRXFR_ACCOUNT", "Chase Checking"),
+        "FIREFLY_SEARCH_WORKERS": int(os.getenv("FIREFLY_SEARCH_WORKERS", 4)),
+        "FIREFLY_CACHE_DIR": os.getenv("FIREFLY_CACHE_DIR", ""),
+        "FIREFLY_CACHE_TTL": float(os.getenv("FIREFLY_CACHE_TTL", 0)),
+        "FIREFLY_SPOOL": os.getenv("FIREFLY_SPOOL", ""),
+        "FIREFLY_SPOOL_TIMEOUT": float(os.getenv("FIREFLY_SPOOL_TIMEOUT", 30)),
+        "FIREFLY_TIMEOUT": float(os.getenv("FIREFLY_TIMEOUT", 60)),
+        "FIREFLY_BREAKER_THRESHOLD": int(os.getenv("FIREFLY_BREAKER_THRESHOLD", 5)),
+        "FIREFLY_BREAKER_COOLDOWN": float(os.getenv("FIREFLY_BREAKER_COOLDOWN", 30)),
+        "FIREFLY_HEDGE_PERCENTILE": float(os.getenv("FIREFLY_HEDGE_PERCENTILE", 0)),
         "FIREFLY_DRY_RUN": bool(os.getenv("FIREFLY_DRY_RUN", True)),
         "SPLITWISE_DAYS": int(os.getenv("SPLITWISE_DAYS", 1)),
+        "SPLITWISE_COMMENT_CACHE": os.getenv("SPLITWISE_COMMENT_CACHE", ""),
+        "SPLITWISE_SHARD_WORKERS": int(os.getenv("SPLITWISE_SHARD_WORKERS", 0)),
+        # Default to enough connections for the concurrent shard fetches
+        "SPLITWISE_POOL_SIZE": int(os.getenv("SPLITWISE_POOL_SIZE", max(4, int(os.getenv("SPLITWISE_SHARD_WORKERS", 0))))),
+        "SPLITWISE_TIMEOUT": float(os.getenv("SPLITWISE_TIMEOUT", 30)),
+        "SPLITWISE_RETRIES": int(os.getenv("SPLITWISE_RETRIES", 3)),
+        "SPLITWISE_USER_CACHE": os.getenv("SPLITWISE_USER_CACHE", ""),
+        "SYNC_QUEUE_SIZE": int(os.getenv("SYNC_QUEUE_SIZE", 10)),
+        "SYNC_TRANSFORM_WORKERS": int(os.getenv("SYNC_TRANSFORM_WORKERS", 1)),
+        "SYNC_WRITE_WORKERS": int(os.getenv("SYNC_WRITE_WORKERS", 1)),
+        "SYNC_BUDGET_SECONDS": float(os.getenv("SYNC_BUDGET_SECONDS", 0)),
+        "SYNC_REMAINDER": os.getenv("SYNC_REMAINDER", ""),
+        "LOG_LEVEL": os.getenv("LOG_LEVEL", "INFO"),
+        "LOG_FORMAT": os.getenv("LOG_FORMAT", "text"),
         "FOREIGN_CURRENCY_TOFIX_TAG": os.getenv("FOREIGN_CURRENCY_TOFIX_TAG"),
         "SW_BALANCE_ACCOUNT": os.getenv("SW_BALANCE_ACCOUNT", False),
         "SW_BALANCE_DEFAULT_DESCRIPTION": os.getenv("SW_BALANCE_DEFAULT_DESCRIPTION", "Splitwise balance"),
+        "HTTP_CASSETTE": os.getenv("HTTP_CASSETTE", ""),
+        "HTTP_CASSETTE_MODE": os.getenv("HTTP_CASSETTE_MODE", "replay"),
+        "HTTP_CASSETTE_LATENCY_SCALE": float(os.getenv("HTTP_CASSETTE_LATENCY_SCALE", 1.0)),
     }
 
 time_now = datetime.now().astimezone()
 conf = load_config()
+logger = logging.getLogger("main")
+# Monotonic time after which no more expenses are synced, see SYNC_BUDGET_SECONDS
+sync_deadline: Optional[float] = None
+# IDs of expenses left for the next run when the budget ran out
+sync_remainder: set = set()
+# Firefly writes waiting for Firefly to be reachable again
+write_spool = WriteSpool(conf["FIREFLY_SPOOL"]) if conf["FIREFLY_SPOOL"] else None
+# Firefly accounts of all types, indexed by normalizeAccountName
+account_index: dict[str, dict] = {}
+account_lock = threading.Lock()
+# Cache for Firefly GET responses, revalidated with ETag/Last-Modified
+response_cache = ResponseCache(conf["FIREFLY_CACHE_DIR"], conf["FIREFLY_CACHE_TTL"], conf["FIREFLY_TOKEN"] or "") if conf["FIREFLY_CACHE_DIR"] else None
+# Latencies and circuit breakers of Firefly endpoints, see getEndpointHealth
+endpoint_health: dict[str, EndpointHealth] = {}
+endpoint_lock = threading.Lock()
+# Installed before any request is made, account currencies are fetched on import
+if conf["HTTP_CASSETTE"]:
+    atexit.register(Cassette(conf["HTTP_CASSETTE"], conf["HTTP_CASSETTE_MODE"], conf["HTTP_CASSETTE_LATENCY_SCALE"]).install().uninstall)
+# Transaction groups added by this run, indexed by getTransactionHash
+txn_hashes: dict[str, dict] = {}
+# Firefly fields parsed from Splitwise comments, indexed by expense ID
+comment_cache: dict[str, dict] = {}
 
 def formatExpense(exp: Expense, myshare: ExpenseUser) -> str:
     """
@@ -72,14 +166,13 @@ def getDate(datestr: str) -> datetime:
     return datetime.fromisoformat(datestr.replace("Z", "+00:00"))
 
 
-def getExpensesAfter(sw: Splitwise, date: datetime, user: User) -> Generator[tuple[Expense, ExpenseUser, list[str]], None, None]:
+def fetchExpenses(sw: Splitwise, **filters) -> list[Expense]:
     """
-    Get Splitwise expenses after a date for a user. Yield a tuple of Expense, ExpenseUser corresponding to my share, and a list of strings for Firefly fields.
-    If no firefly fields found, print a warning.
+    Get all Splitwise expenses matching the filters, walking the pages of the feed.
     :param sw: A Splitwise object
-    :param date: A datetime object, representing the date after which to get expenses
-    :param user: A Splitwise User object for whom to get expenses
-    :return: A generator of tuples of Expense, ExpenseUser, and a list of strings for Firefly fields. If no data found, return None."""
+    :param filters: getExpenses filters, like updated_after or group_id
+    :return: A list of Expense objects, including deleted ones
+    """
     offset = 0
     limit = 20
     expenses: list[Expense] = []
@@ -89,14 +182,75 @@ def getExpensesAfter(sw: Splitwise, date: datetime, user: User) -> Generator[tup
         # getDate is the entered date in the expense
         # getCreatedAt is the date when the expense was created
         # getUpdatedAt is the date when the expense was last updated
-        exp = sw.getExpenses(updated_after=date.isoformat(),
-                             offset=offset, limit=limit)
+        exp = sw.getExpenses(offset=offset, limit=limit, **filters)
         offset += limit
         if not exp:
             break
         expenses.extend(exp)
+    return expenses
+
+
+def fetchExpensesSharded(sw: Splitwise, **filters) -> list[Expense]:
+    """
+    Get all Splitwise expenses matching the filters, fetching the feed of each group concurrently.
+    Expenses with friends outside of groups are in the group with ID 0.
+    :param sw: A Splitwise object
+    :param filters: getExpenses filters, like updated_after
+    :return: A list of Expense objects, de-duplicated by ID
+    """
+    group_ids = {g.getId() for g in sw.getGroups()} | {0}
+    with ThreadPoolExecutor(conf["SPLITWISE_SHARD_WORKERS"]) as executor:
+        shards = executor.map(lambda group_id: fetchExpenses(sw, group_id=group_id, **filters), sorted(group_ids))
+        expenses: dict[int, Expense] = {}
+        for shard in shards:
+            for exp in shard:
+                expenses.setdefault(exp.getId(), exp)
+    return list(expenses.values())
+
+
+def getExpensesAfter(sw: Splitwise, date: datetime, user: User, include_ids: list = ()) -> Generator[tuple[Expense, ExpenseUser, list[str]], None, None]:
+    """
+    Get Splitwise expenses after a date for a user. Yield a tuple of Expense, ExpenseUser corresponding to my share, and a list of strings for Firefly fields.
+    If no firefly fields found, print a warning.
+    If a sync budget is set, the most recently updated expenses come first.
+    :param sw: A Splitwise object
+    :param date: A datetime object, representing the date after which to get expenses
+    :param user: A Splitwise User object for whom to get expenses
+    :param include_ids: IDs of expenses to get as well, even if not updated after the date, e.g. left over by a previous run
+    :return: A generator of tuples of Expense, ExpenseUser, and a list of strings for Firefly fields. If no data found, return None."""
+    if conf["SPLITWISE_SHARD_WORKERS"]:
+        expenses = fetchExpensesSharded(sw, updated_after=date.isoformat())
+    else:
+        expenses = fetchExpenses(sw, updated_after=date.isoformat())
+
+    fetched = {exp.getId() for exp in expenses}
+    for exp_id in include_ids:
+        if exp_id in fetched:
+            continue
+        try:
+            expenses.append(sw.getExpense(exp_id))
+        except Exception as e:
+            logger.warning("Skipping left over expense %s: %s", exp_id, e)
+
+    if conf["SYNC_BUDGET_SECONDS"]:
+        expenses.sort(key=lambda exp: getDate(exp.getUpdatedAt()), reverse=True)
+    yield from selectExpenses(sw, expenses, user)
+
+
+def selectExpenses(sw: Splitwise, expenses: list[Expense], user: User) -> Generator[tuple[Expense, ExpenseUser, list[str]], None, None]:
+    """
+    Select the Splitwise expenses to sync for a user. Yield a tuple of Expense, ExpenseUser corresponding to my share, and a list of strings for Firefly fields.
+    If no firefly fields found, print a warning.
+    :param sw: A Splitwise object
+    :param expenses: A list of Expense objects
+    :param user: A Splitwise User object for whom to get expenses
+    :return: A generator of tuples of Expense, ExpenseUser, and a list of strings for Firefly fields."""
+    for i, exp in enumerate(expenses):
+        if isPastDeadline():
+            sync_remainder.update(e.getId() for e in expenses[i:])
+            logger.warning("Sync budget exhausted, leaving %d expenses for the next run", len(expenses) - i)
+            return
 
-    for exp in expenses:
         # Skip deleted expenses
         if exp.getDeletedAt():
             continue
@@ -130,17 +284,13 @@ def getExpensesAfter(sw: Splitwise, date: datetime, user: User) -> Generator[tup
         if accept_check and (details := processText(exp.getDetails())):
             data = details
 
-        c: Comment
-        for c in sw.getComments(exp.getId()):
-            if c.getCommentedUser().getId() != user.getId():
-                pass
-            if text := processText(c.getContent()):
-                data = text
+        if text := getCommentData(sw, exp, user):
+            data = text
 
         # If not found, do not process, report
         if not data:
-            print(
-                f"-----> {formatExpense(exp, myshare)} matches, no comment found! Enter manually.")
+            logger.warning("-----> %s matches, no comment found! Enter manually.", Lazy(formatExpense, exp, myshare),
+                           extra={"external_url": getSWUrlForExpense(exp)})
             continue
         if data[0] == True:
             data = []
@@ -148,6 +298,100 @@ def getExpensesAfter(sw: Splitwise, date: datetime, user: User) -> Generator[tup
         yield exp, myshare, data
 
 
+def isPastDeadline() -> bool:
+    """
+    Check whether the sync budget has run out.
+    :return: True if a budget is set and its deadline has passed
+    """
+    return sync_deadline is not None and time.monotonic() >= sync_deadline
+
+
+def loadRemainder(path: str) -> list:
+    """
+    Load the IDs of expenses a previous run did not get to.
+    :param path: Path to the JSON remainder file. If empty, nothing is loaded.
+    :return: A list of expense IDs. Empty if the file is missing or unreadable.
+    """
+    if not path:
+        return []
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+
+def saveRemainder(path: str, ids: set) -> None:
+    """
+    Save the IDs of expenses this run did not get to, replacing the file atomically.
+    :param path: Path to the JSON remainder file. If empty, nothing is saved.
+    :param ids: A set of expense IDs
+    :return: None
+    """
+    if not path:
+        return
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(sorted(ids), f)
+    os.replace(tmp, path)
+
+
+def getCommentData(sw: Splitwise, exp: Expense, user: User) -> list[str]:
+    """
+    Get data for Firefly fields from the latest matching comment on an expense.
+    Comments are only fetched if the expense was updated or commented on since they were last cached.
+    :param sw: A Splitwise object
+    :param exp: A Splitwise Expense object
+    :param user: A Splitwise User object for whom to get expenses
+    :return: A list of strings as returned by processText. If no comment matches, return empty list.
+    """
+    key = str(exp.getId())
+    stamp = [exp.getUpdatedAt(), exp.getCommentsCount()]
+    if (cached := comment_cache.get(key)) and cached["stamp"] == stamp:
+        return cached["data"]
+
+    data: list[str] = []
+    c: Comment
+    for c in sw.getComments(exp.getId()):
+        if c.getCommentedUser().getId() != user.getId():
+            pass
+        if text := processText(c.getContent()):
+            data = text
+    comment_cache[key] = {"stamp": stamp, "data": data}
+    return data
+
+
+def loadCommentCache(path: str) -> dict[str, dict]:
+    """
+    Load the comment cache from disk.
+    :param path: Path to the JSON cache file. If empty, caching across runs is disabled.
+    :return: A dictionary of cached comment data indexed by expense ID. Empty if the file is missing or unreadable.
+    """
+    if not path:
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning("Ignoring comment cache %s: %s", path, e)
+        return {}
+
+
+def saveCommentCache(path: str, cache: dict[str, dict]) -> None:
+    """
+    Save the comment cache to disk, replacing the file atomically.
+    :param path: Path to the JSON cache file. If empty, nothing is saved.
+    :param cache: A dictionary of cached comment data indexed by expense ID
+    :return: None
+    """
+    if not path:
+        return
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(cache, f)
+    os.replace(tmp, path)
+
+
 def processText(text: str) -> list[str]:
     """
     Process expense test to get data for Firefly fields.
@@ -162,7 +406,7 @@ def processText(text: str) -> list[str]:
     return []
 
 
-def callApi(path, method="POST", params={}, body={}, fail=True):
+def callApi(path, method="POST", params={}, body={}, fail=True, timeout=None):
     """
     Call Firefly API.
     :param path: The API subpath
@@ -170,7 +414,9 @@ def callApi(path, method="POST", params={}, body={}, fail=True):
     :param params: A dictionary of query parameters
     :param body: A dictionary of the request body
     :param fail: Whether to raise an exception on failure
+    :param timeout: Seconds to wait for Firefly. If None, FIREFLY_TIMEOUT.
     :return: The response object
+    :raises: CircuitOpenError, a requests.ConnectionError, without calling Firefly if the endpoint keeps failing
     """
     baseUrl = conf["FIREFLY_URL"]
     token = conf["FIREFLY_TOKEN"]
@@ -181,35 +427,154 @@ def callApi(path, method="POST", params={}, body={}, fail=True):
     }
 
     if method != "GET" and conf["FIREFLY_DRY_RUN"]:
-        print(f"Skipping {method} call due to dry run.")
+        logger.info("Skipping %s call due to dry run.", method)
         res = requests.Response()
         res.status_code, res._content = 200, b"{}"
         return res
 
-    res = requests.request(
+    url = f"{baseUrl}/api/v1/{path}"
+    cache_key, entry = None, None
+    if method == "GET" and response_cache:
+        cache_key = response_cache.key(url, params)
+        if entry := response_cache.get(cache_key):
+            if response_cache.is_fresh(entry):
+                return response_cache.response(entry, url)
+            headers.update(response_cache.validators(entry))
+
+    health = getEndpointHealth(path)
+    health.check()
+    send = lambda: requests.request(
         method,
-        f"{baseUrl}/api/v1/{path}",
+        url,
         headers=headers,
         params=params,
         json=body,
+        timeout=timeout or conf["FIREFLY_TIMEOUT"] or None,
     )
+    delay = health.percentile(conf["FIREFLY_HEDGE_PERCENTILE"]) if method == "GET" and conf["FIREFLY_HEDGE_PERCENTILE"] else None
+    start = time.monotonic()
+    # Other errors, e.g. an unserializable body, say nothing about Firefly
+    ok = True
+    try:
+        res = hedge(send, delay) if delay is not None else send()
+        ok = res.status_code not in range(500, 600)
+    except requests.RequestException as e:
+        ok = not isFireflyUnavailable(e)
+        raise
+    finally:
+        # Always recorded, also ends a trial call of a half-open circuit
+        health.record(time.monotonic() - start, ok)
+    if cache_key:
+        if res.status_code == 304 and entry:
+            response_cache.touch(cache_key, entry)
+            return response_cache.response(entry, url)
+        if res.status_code == 200:
+            response_cache.store(cache_key, res)
     if fail:
         res.raise_for_status()
     return res
 
 
-def searchTransactions(params: dict[str, str]) -> list[dict]:
+def getEndpointHealth(path: str) -> EndpointHealth:
+    """
+    Get the latency and circuit breaker tracking of a Firefly endpoint.
+    :param path: The API subpath. IDs are dropped, so "transactions/1" and "transactions/2" share an endpoint.
+    :return: The EndpointHealth of the endpoint
+    """
+    endpoint = "/".join(part for part in path.strip("/").split("/") if not part.isdigit())
+    with endpoint_lock:
+        if endpoint not in endpoint_health:
+            endpoint_health[endpoint] = EndpointHealth(endpoint, conf["FIREFLY_BREAKER_THRESHOLD"], conf["FIREFLY_BREAKER_COOLDOWN"])
+        return endpoint_health[endpoint]
+
+
+def isFireflyUnavailable(e: Exception) -> bool:
+    """
+    Check whether a failed Firefly call is worth retrying later.
+    :param e: The exception raised by callApi
+    :return: True if Firefly could not be reached, timed out, or failed with a server error
+    """
+    if isinstance(e, (requests.ConnectionError, requests.Timeout)):
+        return True
+    return isinstance(e, requests.HTTPError) and e.response is not None and e.response.status_code >= 500
+
+
+def writeApi(path: str, method: str, body: dict) -> Optional[dict]:
+    """
+    Call a Firefly write endpoint. If the spool is enabled and Firefly is unavailable or slower than
+    FIREFLY_SPOOL_TIMEOUT, spool the request for the next run instead of failing.
+    :param path: The API subpath
+    :param method: The HTTP method
+    :param body: A dictionary of the request body
+    :return: The response JSON, or None if the request was spooled
+    :raises: Exception if the call fails for another reason
+    """
+    if not write_spool:
+        return callApi(path, method=method, body=body).json()
+    try:
+        return callApi(path, method=method, body=body, timeout=conf["FIREFLY_SPOOL_TIMEOUT"]).json()
+    except requests.RequestException as e:
+        if not isFireflyUnavailable(e):
+            raise
+        write_spool.append({"method": method, "path": path, "body": body})
+        logger.warning("Firefly unavailable, spooled %s %s: %s", method, path, e)
+        return None
+
+
+def flushSpool() -> int:
+    """
+    Send the requests spooled by previous runs to Firefly, oldest first.
+    Stops at the first request that finds Firefly still unavailable and keeps it and the rest for the next run.
+    Requests Firefly rejects (like duplicates of a timed out add that went through) are dropped.
+    :return: The number of requests sent
+    """
+    entries = write_spool.load() if write_spool else []
+    sent = 0
+    for i, entry in enumerate(entries):
+        try:
+            callApi(entry["path"], method=entry["method"], body=entry["body"], timeout=conf["FIREFLY_SPOOL_TIMEOUT"])
+            sent += 1
+        except requests.RequestException as e:
+            if isFireflyUnavailable(e):
+                logger.warning("Firefly still unavailable, keeping %d spooled requests: %s", len(entries) - i, e)
+                write_spool.replace(entries[i:])
+                return sent
+            logger.error("Dropping spooled %s %s, body: %s, e: %s", entry["method"], entry["path"], entry["body"], e)
+    if entries:
+        logger.info("Flushed %d spooled requests", sent)
+        write_spool.replace([])
+    return sent
+
+
+def searchTransactions(params: dict[str, str], project: Callable[[dict], dict] = None) -> list[dict]:
     """
     Search transactions on Firefly.
+    If the first page reports the total number of pages, fetch the remaining pages concurrently. Otherwise, walk pages until an empty one.
     :param params: A dictionary of query parameters
+    :param project: A function applied to each transaction group as its page arrives, e.g. projectTransactionGroup. If None, keep the full JSON.
     :return: A list of transactions
     """
-    txns: list[dict] = []
-    page = 1
+    def getPage(page: int) -> dict:
+        res = callApi("search/transactions", "GET", {**params, "page": page}).json()
+        if project:
+            res["data"] = [project(t) for t in res["data"]]
+        return res
+
+    first = getPage(1)
+    txns: list[dict] = first["data"]
+    if not txns:
+        return txns
+
+    total_pages = first.get("meta", {}).get("pagination", {}).get("total_pages")
+    if isinstance(total_pages, int):
+        with ThreadPoolExecutor(max(1, conf["FIREFLY_SEARCH_WORKERS"])) as executor:
+            for res in executor.map(getPage, range(2, total_pages + 1)):
+                txns.extend(res["data"])
+        return txns
+
+    page = 2
     while True:
-        params["page"] = page
-        txn: list[dict] = callApi(
-            "search/transactions", "GET", params).json()["data"]
+        txn: list[dict] = getPage(page)["data"]
         page += 1
         if not txn:
             break
@@ -226,10 +591,94 @@ def getTransactionsAfter(date: datetime) -> dict[str, dict]:
     days: int = (time_now - date).days
     # https://docs.firefly-iii.org/firefly-iii/pages-and-features/search/
     params = {"query": f'date_after:"-{days}d" any_external_url:true'}
-    txns = searchTransactions(params)
+    txns = searchTransactions(params, projectTransactionGroup)
     return {t["attributes"]["transactions"][0]["external_url"]: t for t in txns}
 
 
+# Split fields compared and written by updateTransaction, see getExpenseTransactionBody and applyAmountToTransaction.
+# source_id and destination_id are left out so that Firefly resolves the accounts by name on update.
+TRANSACTION_FIELDS = [
+    "transaction_journal_id", "type", "date", "payment_date", "amount", "foreign_amount", "foreign_currency_code",
+    "source_name", "destination_name", "category_name", "description", "notes", "reconciled", "external_url", "tags",
+]
+
+
+def projectTransactionGroup(txn: dict) -> dict:
+    """
+    Project a Firefly transaction group JSON to the fields used by the sync.
+    :param txn: A transaction group as returned by the Firefly API
+    :return: A transaction group with the same layout, holding only the ID, group title and TRANSACTION_FIELDS of each split
+    """
+    attributes = txn["attributes"]
+    return {
+        "id": txn.get("id"),
+        "attributes": {
+            "group_title": attributes.get("group_title"),
+            "transactions": [{k: split[k] for k in TRANSACTION_FIELDS if k in split} for split in attributes["transactions"]],
+        },
+    }
+
+
+def getTransactionHash(txn: Union[dict, list[dict]]) -> str:
+    """
+    Get a fingerprint of the submitted fields Firefly hashes to detect duplicate transactions, including the external URL.
+    Works on both new transaction bodies and the splits of a Firefly transaction group.
+    :param txn: A dictionary of the transaction body, or a list of such dictionaries for a split transaction
+    :return: A hex digest, equal for transactions Firefly would consider duplicates
+    """
+    txns: list[dict] = [txn] if isinstance(txn, dict) else txn
+    splits = []
+    for t in txns:
+        # Firefly returns null for fields submitted empty
+        split = {k: t.get(k) or None for k in ["type", "description", "source_name", "destination_name", "foreign_currency_code",
+                                               "category_name", "notes", "external_url"]}
+        split["tags"] = sorted(t.get("tags") or []) or None
+        # Firefly has a lot of 0 after decimal
+        for k in ["amount", "foreign_amount"]:
+            split[k] = f"{float(t[k]):.2f}" if t.get(k) is not None else None
+        # Firefly stores time with timezone
+        split["date"] = getDate(t["date"]).astimezone(timezone.utc).isoformat() if t.get("date") else None
+        splits.append(split)
+    splits.sort(key=lambda x: json.dumps(x, sort_keys=True))
+    return hashlib.sha256(json.dumps(splits, sort_keys=True).encode()).hexdigest()
+
+
+def orderSplits(txns: list[dict]) -> list[dict]:
+    """
+    Order the splits of a transaction so that the balance account cover split comes last.
+    :param txns: A list of split transaction dictionaries
+    :return: The reordered list
+    """
+    cover = [txn for txn in txns if txn['description'].startswith('Cover for:')]
+    return [txn for txn in txns if not txn['description'].startswith('Cover for:')] + cover
+
+
+def getSplitDiff(old: dict, new: dict) -> list[str]:
+    """
+    Compare a Firefly split with a new transaction body.
+    :param old: A dictionary of the Firefly split
+    :param new: A dictionary of the new transaction body
+    :return: The keys of new whose values differ on Firefly. Empty if no update is needed.
+    """
+    diff = []
+    for k, new_val in new.items():
+        if (old_val := old.get(k)) != new_val:
+            # Firefly returns null for fields submitted empty
+            if not old_val and not new_val:
+                continue
+            # Firefly has a lot of 0 after decimal
+            if k in ("amount", "foreign_amount") and old_val is not None and new_val is not None \
+                    and float(old_val) == float(new_val):
+                continue
+            # Firefly stores time with timezone
+            # See https://github.com/firefly-iii/firefly-iii/issues/6810
+            if k == "date" or k == "payment_date":
+                if getDate(old_val) == getDate(new_val):
+                    continue
+            diff.append(k)
+    return diff
+
+
 def updateTransaction(newTxn: dict, oldTxnBody: dict) -> None:
     """
     Update a transaction on Firefly, if needed.
@@ -244,44 +693,32 @@ def updateTransaction(newTxn: dict, oldTxnBody: dict) -> None:
     newTxns: list[dict] = [newTxn] if isinstance(newTxn, dict) else newTxn
 
     if len(newTxns) > 1:
-        # order lists so that the first element is the one that is not the balance account transaction
-        cover_new = [txn for txn in newTxns if txn['description'].startswith('Cover for:')]
-        cover_old = [txn for txn in oldTxns if txn['description'].startswith('Cover for:')]
-        newTxns = [txn for txn in newTxns if not txn['description'].startswith('Cover for:')] + cover_new
-        oldTxns = [txn for txn in oldTxns if not txn['description'].startswith('Cover for:')] + cover_old
+        newTxns = orderSplits(newTxns)
+        oldTxns = orderSplits(oldTxns)
 
     for old, new in zip(oldTxns, newTxns):
-        for k, new_val in new.items():
-            if (old_val := old[k]) != new_val:
-                # Firefly has a lot of 0 after decimal
-                if k == "amount" and float(old_val) == float(new_val):
-                    continue
-                # Firefly stores time with timezone
-                # See https://github.com/firefly-iii/firefly-iii/issues/6810
-                if k == "date" or k == "payment_date":
-                    if getDate(old_val) == getDate(new_val):
-                        continue
-                break
-        else:
-            print(f"No update needed for {new['description']}")
+        if not getSplitDiff(old, new):
+            logger.debug("No update needed for %s", new['description'], extra={"transaction_id": old_id})
             return
 
         old.update(new)
 
         # https://github.com/firefly-iii/firefly-iii/issues/6828
-        del old["foreign_currency_id"]
+        old.pop("foreign_currency_id", None)
 
     oldTxnBody["transactions"] = oldTxns
     descriptions = ','.join([txn['description'] for txn in oldTxns])
     try:
-        callApi(f"transactions/{old_id}", method="PUT", body=oldTxnBody).json()
+        if writeApi(f"transactions/{old_id}", "PUT", oldTxnBody) is None:
+            logger.warning("Spooled Transactions: %s", descriptions, extra={"transaction_id": old_id})
+            return
     except Exception as e:
-        print(f"Transactions {descriptions} errored, body: {oldTxnBody}, e: {e}")
+        logger.error("Transactions %s errored, body: %s, e: %s", descriptions, oldTxnBody, e, extra={"transaction_id": old_id})
         raise
-    print(f"Updated Transactions: {descriptions}")
+    logger.info("Updated Transactions: %s", descriptions, extra={"transaction_id": old_id})
 
 
-def addTransaction(newTxn: Union[dict, list[dict]], group_title=None) -> None:
+def addTransaction(newTxn: Union[dict, list[dict]], group_title=None) -> dict:
     """
     Add a transaction to Firefly.
 
@@ -289,7 +726,7 @@ def addTransaction(newTxn: Union[dict, list[dict]], group_title=None) -> None:
 
     :param newTxn: A dictionary of the transaction body, or a list of such dictionaries for a split transaction.
     :param group_title: The title of the transaction group. If None, use the description of the first transaction.
-    :return: None
+    :return: The created transaction group, or None if Firefly did not return one (dry run, spooled).
     :raises: Exception if the transaction add fails.
     """
 
@@ -301,12 +738,15 @@ def addTransaction(newTxn: Union[dict, list[dict]], group_title=None) -> None:
         "transactions": txns
     }
     try:
-        callApi("transactions", method="POST", body=body).json()
+        if (res := writeApi("transactions", "POST", body)) is None:
+            logger.warning("Spooled Transaction: %s", group_title)
+            return None
+        created = res.get("data")
     except Exception as e:
-        print(
-            f"Transaction {group_title} errored, body: {body}, e: {e}")
+        logger.error("Transaction %s errored, body: %s, e: %s", group_title, body, e)
         raise
-    print(f"Added Transaction: {group_title}")
+    logger.info("Added Transaction: %s", group_title)
+    return created
 
 
 def processExpense(past_day: datetime, txns: dict[dict], exp: Expense, *args) -> None:
@@ -319,7 +759,17 @@ def processExpense(past_day: datetime, txns: dict[dict], exp: Expense, *args) ->
     :param args: A list of strings for Firefly fields.
     :return: None
     """
+    writeExpenseTransactions(past_day, txns, *getExpenseTransactions(exp, *args))
 
+
+def getExpenseTransactions(exp: Expense, *args) -> tuple[Expense, list[Union[dict, list[dict]]]]:
+    """
+    Build the Firefly transactions for a Splitwise expense using the configured strategy.
+
+    :param exp: A Splitwise Expense object.
+    :param args: A list of strings for Firefly fields.
+    :return: A tuple of the expense and its transaction bodies, each with the external URL set.
+    """
     strategy = get_transaction_strategy()
     new_txns: list = strategy.create_transactions(exp, *args)
     for idx, new_txn in enumerate(new_txns):
@@ -331,19 +781,108 @@ def processExpense(past_day: datetime, txns: dict[dict], exp: Expense, *args) ->
         else:
             for split in new_txn:
                 split["external_url"] = external_url
-        
+    return exp, new_txns
+
+
+def getExternalUrl(txn: Union[dict, list[dict]]) -> str:
+    """
+    Get the external URL of a transaction body.
+
+    :param txn: A dictionary of the transaction body, or a list of such dictionaries for a split transaction.
+    :return: The external URL
+    """
+    return txn["external_url"] if isinstance(txn, dict) else txn[0]["external_url"]
+
+
+def writeExpenseTransactions(past_day: datetime, txns: dict[dict], exp: Expense, new_txns: list[Union[dict, list[dict]]]) -> None:
+    """
+    Update or add the transactions of a Splitwise expense on Firefly.
+
+    :param past_day: A datetime object. Expenses before this date are ignored.
+    :param txns: A dictionary of transactions indexed by Splitwise external URL.
+    :param exp: A Splitwise Expense object.
+    :param new_txns: The transaction bodies from getExpenseTransactions.
+    :return: None
+    """
+    if isPastDeadline():
+        sync_remainder.add(exp.getId())
+        return
+    for idx, new_txn in enumerate(new_txns):
+        external_url = getExternalUrl(new_txn)
         if oldTxnBody := txns.get(external_url):
-            print(f"Updating transaction {idx + 1}...")
+            logger.debug("Updating transaction %d...", idx + 1, extra={"external_url": external_url})
             updateTransaction(new_txn, oldTxnBody)
             continue
         if getDate(exp.getCreatedAt()) < past_day or getDate(exp.getDate()) < past_day:
-            if search := searchTransactions({"query": f'external_url_is:"{external_url}"'}):
-                print(f"Updating old transaction {idx + 1}...")
+            if search := searchTransactions({"query": f'external_url_is:"{external_url}"'}, projectTransactionGroup):
+                logger.debug("Updating old transaction %d...", idx + 1, extra={"external_url": external_url})
                 # TODO(#1): This would have 2 results for same splitwise expense
                 updateTransaction(new_txn, search[0])
                 continue
-        print(f"Adding transaction {idx + 1}...")
-        addTransaction(new_txn)
+        # Firefly would reject this as a duplicate of a group added earlier in the run, e.g. for an expense fetched twice
+        txn_hash = getTransactionHash(new_txn)
+        if txn_hash in txn_hashes:
+            logger.debug("Skipping duplicate transaction %d...", idx + 1, extra={"external_url": external_url})
+            continue
+        logger.debug("Adding transaction %d...", idx + 1, extra={"external_url": external_url})
+        if created := addTransaction(new_txn):
+            txn_hashes[txn_hash] = created
+
+
+def planExpenseTransactions(past_day: datetime, txns: dict[dict], exp: Expense, new_txns: list[Union[dict, list[dict]]]) -> list[dict]:
+    """
+    Plan the operations writeExpenseTransactions would make for a Splitwise expense, without writing to Firefly.
+
+    Transactions created before past_day are not in txns and need a search, which is left to applyOperation.
+
+    :param past_day: A datetime object. Expenses before this date need a lookup.
+    :param txns: A dictionary of transactions indexed by Splitwise external URL.
+    :param exp: A Splitwise Expense object.
+    :param new_txns: The transaction bodies from getExpenseTransactions.
+    :return: A list of operations, dictionaries with "op" (add, update, skip or lookup), "external_url", "body", the Firefly "id", "old" group and "diff" keys where needed, and the estimated Firefly API "calls"
+    """
+    ops = []
+    for new_txn in new_txns:
+        op = {"external_url": getExternalUrl(new_txn), "body": new_txn}
+        old = txns.get(op["external_url"])
+        if old is None and (getDate(exp.getCreatedAt()) < past_day or getDate(exp.getDate()) < past_day):
+            # A search, then an update of the result or an add
+            ops.append({**op, "op": "lookup", "calls": 2})
+            continue
+        if old is None:
+            ops.append({**op, "op": "add", "calls": 1})
+        elif diff := getTransactionDiff(new_txn, old):
+            ops.append({**op, "op": "update", "id": old["id"], "diff": diff, "old": old, "calls": 1})
+        else:
+            ops.append({**op, "op": "skip", "id": old["id"], "calls": 0})
+    return ops
+
+
+def applyOperation(op: dict) -> None:
+    """
+    Apply an operation of a sync plan or an audit fix plan on Firefly.
+
+    :param op: An operation from planExpenseTransactions or getFixOperations, or an "account" to create. Updates without the "old" group fetch it first.
+    :return: None
+    :raises: Exception if the operation fails
+    """
+    if op["op"] == "account":
+        callApi("accounts", method="POST", body=op["body"])
+        logger.info("Created %s account: %s", op["body"]["type"], op["body"]["name"])
+    elif op["op"] == "add":
+        addTransaction(op["body"])
+    elif op["op"] == "update":
+        old = op.get("old") or projectTransactionGroup(callApi(f"transactions/{op['id']}", method="GET").json()["data"])
+        updateTransaction(op["body"], old)
+    elif op["op"] == "lookup":
+        search = searchTransactions({"query": f'external_url_is:"{op["external_url"]}"'}, projectTransactionGroup)
+        if search:
+            updateTransaction(op["body"], search[0])
+        else:
+            addTransaction(op["body"])
+    elif op["op"] == "delete":
+        callApi(f"transactions/{op['id']}", method="DELETE")
+        logger.info("Deleted Transaction: %s", op["id"], extra={"external_url": op["external_url"]})
 
 
 def getExpenseTransactionBody(exp: Expense, myshare: ExpenseUser, data: list[str]) -> dict:
@@ -399,8 +938,7 @@ def getExpenseTransactionBody(exp: Expense, myshare: ExpenseUser, data: list[str
         "tags": [],
     }
     newTxn = applyAmountToTransaction(newTxn, exp, myshare.getOwedShare())
-    print(
-        f"Processing {category} {formatExpense(exp, myshare)} from {source} to {dest}")
+    logger.info("Processing %s %s from %s to %s", category, Lazy(formatExpense, exp, myshare), source, dest)
     return newTxn
 
 def applyAmountToTransaction(transaction: dict, exp: Expense, amount: float) -> dict:
@@ -435,12 +973,104 @@ def get_transaction_strategy() -> TransactionStrategy:
         return StandardTransactionStrategy(getExpenseTransactionBody)
 
 def getAccounts(account_type: str="asset") -> list:
-    """Get accounts from Firefly.
+    """Get accounts from Firefly, following pagination.
 
     :param account_type: The type of account
     :return: A list of accounts
     """
-    return callApi("accounts/", method="GET", params={"type": account_type}).json()['data']
+    res = callApi("accounts/", method="GET", params={"type": account_type}).json()
+    accounts = res['data']
+    total_pages = res.get('meta', {}).get('pagination', {}).get('total_pages')
+    if isinstance(total_pages, int):
+        for page in range(2, total_pages + 1):
+            accounts.extend(callApi("accounts/", method="GET", params={"type": account_type, "page": page}).json()['data'])
+    return accounts
+
+def normalizeAccountName(name: str) -> str:
+    """Normalize an account name for lookups, ignoring case and repeated whitespace.
+
+    :param name: The account name
+    :return: The normalized name
+    """
+    return " ".join(name.split()).casefold()
+
+def getAccountIndex(account_types: list[str] = ["asset", "expense", "revenue"]) -> dict[str, dict]:
+    """Get all accounts of the given types from Firefly, indexed by normalized name.
+
+    :param account_types: The types of account to load
+    :return: A dictionary of accounts (name, type, currency_code) indexed by normalizeAccountName
+    """
+    index = {}
+    for account_type in account_types:
+        for account in getAccounts(account_type):
+            attributes = account["attributes"]
+            index[normalizeAccountName(attributes["name"])] = {
+                "name": attributes["name"],
+                "type": attributes.get("type", account_type),
+                "currency_code": attributes.get("currency_code"),
+            }
+    return index
+
+def getMissingAccounts(txns: list[Union[dict, list[dict]]]) -> dict[str, dict]:
+    """Get the accounts Firefly would auto-create when writing the given transactions.
+
+    Withdrawals pay to expense accounts and deposits are paid from revenue accounts, both created by name if missing.
+
+    :param txns: A list of transaction bodies, or lists of such dictionaries for split transactions
+    :return: A dictionary of the missing accounts (name, type) indexed by normalized name
+    """
+    missing = {}
+    for txn in txns:
+        for split in [txn] if isinstance(txn, dict) else txn:
+            if split["type"] == "withdrawal":
+                name, account_type = split["destination_name"], "expense"
+            elif split["type"] == "deposit":
+                name, account_type = split["source_name"], "revenue"
+            else:
+                continue
+            if name and (key := normalizeAccountName(name)) not in account_index:
+                missing.setdefault(key, {"name": name, "type": account_type})
+    return missing
+
+def createMissingAccounts(txns: list[Union[dict, list[dict]]]) -> list[dict]:
+    """Create the accounts a batch of transactions needs before any of them is written.
+
+    Creating them up front keeps concurrent transaction writes from racing to auto-create the same account. Skipped
+    while Firefly is unavailable: the transaction writes are spooled then, and Firefly creates their accounts when the
+    spool is flushed.
+
+    :param txns: A list of transaction bodies, or lists of such dictionaries for split transactions
+    :return: A list of the created accounts. Empty in dry run.
+    :raises: Exception if an account could not be created for another reason
+    """
+    with account_lock:
+        created = []
+        for key, account in getMissingAccounts(txns).items():
+            try:
+                callApi("accounts", method="POST", body=account)
+            except requests.RequestException as e:
+                if not isFireflyUnavailable(e):
+                    raise
+                logger.warning("Firefly unavailable, not creating %s account %s up front: %s", account["type"], account["name"], e)
+                break
+            account_index[key] = {**account, "currency_code": None}
+            if conf["FIREFLY_DRY_RUN"]:
+                continue
+            logger.info("Created %s account: %s", account["type"], account["name"])
+            created.append(account)
+        return created
+
+def createExpenseAccounts(item: tuple[Expense, list]) -> tuple[Expense, list]:
+    """Create the missing accounts of an expense's transactions, see createMissingAccounts.
+
+    Skipped once the sync budget ran out, since writeExpenseTransactions leaves the expense for the next run then.
+
+    :param item: A tuple of the expense and its transaction bodies, as returned by getExpenseTransactions
+    :return: The item, unchanged
+    """
+    if not isPastDeadline():
+        createMissingAccounts(item[1])
+    return item
 
 def cache_account_currency(function):
     account_name_currency = dict(
@@ -470,20 +1100,382 @@ def getAccountCurrencyCode(account_name: str) -> str:
     raise Exception("Will not be called")
 
 
-if __name__ == "__main__":
+def getTransactionDiff(newTxn: Union[dict, list[dict]], oldTxnBody: dict) -> list[str]:
+    """
+    Compare all splits of a Firefly transaction group with a new transaction body.
+    :param newTxn: A dictionary of the new transaction body, or a list of such dictionaries for a split transaction
+    :param oldTxnBody: A Firefly transaction group
+    :return: The sorted keys that differ on Firefly. "transactions" if the number of splits differs. Empty if in sync.
     """
-    Main function. Get Splitwise expenses after a date and process them - update or add transactions on Firefly.
+    newTxns: list[dict] = [newTxn] if isinstance(newTxn, dict) else newTxn
+    oldTxns: list[dict] = oldTxnBody["attributes"]["transactions"]
+    if len(newTxns) != len(oldTxns):
+        return ["transactions"]
+    if len(newTxns) > 1:
+        newTxns = orderSplits(newTxns)
+        oldTxns = orderSplits(oldTxns)
+    return sorted({k for old, new in zip(oldTxns, newTxns) for k in getSplitDiff(old, new)})
+
+
+def getAuditWindows(since: datetime, until: datetime, days: int) -> Generator[tuple[datetime, datetime], None, None]:
+    """
+    Split a date range into consecutive windows.
+    :param since: Start of the range
+    :param until: End of the range
+    :param days: Length of each window in days
+    :return: A generator of (start, end) tuples. The last window ends at until.
+    """
+    start = since
+    while start < until:
+        end = min(start + timedelta(days=days), until)
+        yield start, end
+        start = end
+
+
+def getExpectedTransactions(sw: Splitwise, user: User, start: datetime, end: datetime) -> tuple[dict[str, Union[dict, list[dict]]], set[str], dict[str, str]]:
+    """
+    Get the Firefly transaction bodies that the sync would write for Splitwise expenses dated in a window.
+    :param sw: A Splitwise object
+    :param user: A Splitwise User object for whom to get expenses
+    :param start: Start of the window
+    :param end: End of the window
+    :return: A tuple of the transaction bodies indexed by external URL, the URLs of expenses deleted on Splitwise, and
+        the errors of expenses whose transactions could not be built (e.g. a closed source account) indexed by URL
+    """
+    filters = {"dated_after": start.isoformat(), "dated_before": end.isoformat()}
+    if conf["SPLITWISE_SHARD_WORKERS"]:
+        expenses = fetchExpensesSharded(sw, **filters)
+    else:
+        expenses = fetchExpenses(sw, **filters)
+    deleted = {getSWUrlForExpense(exp) for exp in expenses if exp.getDeletedAt()}
+    # Comments of the window are evicted afterwards, only the entries loaded from SPLITWISE_COMMENT_CACHE are kept
+    cached = comment_cache.keys() & {str(exp.getId()) for exp in expenses}
+    expected, failed = {}, {}
+    try:
+        for e in selectExpenses(sw, expenses, user):
+            try:
+                _, new_txns = getExpenseTransactions(*e)
+            except ValueError as err:
+                failed[getSWUrlForExpense(e[0])] = str(err)
+                continue
+            for new_txn in new_txns:
+                expected[getExternalUrl(new_txn)] = new_txn
+    finally:
+        for exp in expenses:
+            if (key := str(exp.getId())) not in cached:
+                comment_cache.pop(key, None)
+    return expected, deleted, failed
+
+
+def getExpenseUrl(external_url: str) -> str:
+    """
+    Get the Splitwise expense URL of a transaction external URL, without the balance transfer suffix.
+    :param external_url: The external URL, as set by getExpenseTransactions
+    :return: The expense URL
+    """
+    return external_url.split("-balance_transfer-")[0]
+
+
+def getActualTransactions(start: datetime, end: datetime, include_end: bool = False) -> dict[str, list[dict]]:
+    """
+    Get the Firefly transaction groups synced from Splitwise with a payment date in a window.
+    :param start: Start of the window
+    :param end: End of the window
+    :param include_end: Whether to include the day of end, for the last window. Otherwise it belongs to the next window.
+    :return: A dictionary of lists of transaction groups indexed by external URL. More than one group means a duplicate.
+    """
+    # https://docs.firefly-iii.org/firefly-iii/pages-and-features/search/
+    # Both operators include the given day
+    last_day = end.date() if include_end else (end - timedelta(days=1)).date()
+    params = {"query": f'payment_date_after:"{start.date()}" payment_date_before:"{last_day}" '
+                       f'external_url_starts:"{Splitwise.SPLITWISE_BASE_URL}expenses/"'}
+    actual: dict[str, list[dict]] = {}
+    for t in searchTransactions(params, projectTransactionGroup):
+        actual.setdefault(t["attributes"]["transactions"][0]["external_url"], []).append(t)
+    return actual
+
+
+def auditTransactions(sw: Splitwise, user: User, since: datetime, until: datetime, window_days: int) -> Generator[dict, None, None]:
+    """
+    Reconcile Firefly with Splitwise over a date range.
+
+    Both sides are loaded one window at a time and merge-joined by external URL, so memory is bounded by the window size.
+    Unmatched entries are carried over to the next window before being reported, since the Splitwise date and the
+    Firefly payment date can fall on different days around midnight.
+
+    :param sw: A Splitwise object
+    :param user: A Splitwise User object for whom to get expenses
+    :param since: Start of the range
+    :param until: End of the range
+    :param window_days: Length of each window in days
+    :return: A generator of findings, dictionaries with "kind" (missing, orphaned, duplicated, drifted or failed), "external_url", "ids" of the Firefly groups, "diff" keys and the expected "body". Orphaned findings tell whether the expense was "deleted" on Splitwise, failed findings have the "error".
+    """
+    carry_expected: dict[str, Union[dict, list[dict]]] = {}
+    carry_actual: dict[str, list[dict]] = {}
+    # Expense URLs, only deleted and failing expenses are kept across windows
+    deleted: set[str] = set()
+    failed: set[str] = set()
+    # A final empty window reports everything still carried over
+    for window in [*getAuditWindows(since, until, window_days), None]:
+        expected, actual = carry_expected, carry_actual
+        carried = expected.keys() | actual.keys()
+        carry_expected, carry_actual = {}, {}
+        if window:
+            logger.info("Auditing %s to %s", window[0].date(), window[1].date())
+            window_expected, window_deleted, window_failed = getExpectedTransactions(sw, user, *window)
+            expected.update(window_expected)
+            deleted |= window_deleted
+            for url, error in window_failed.items():
+                failed.add(url)
+                yield {"external_url": url, "ids": [], "diff": [], "body": None, "kind": "failed", "error": error}
+            for url, groups in getActualTransactions(*window, include_end=window[1] == until).items():
+                actual.setdefault(url, []).extend(groups)
+
+        for url in sorted(expected.keys() | actual.keys()):
+            new_txn, groups = expected.get(url), actual.get(url, [])
+            if (new_txn is None or not groups) and url not in carried:
+                if new_txn is None:
+                    carry_actual[url] = groups
+                else:
+                    carry_expected[url] = new_txn
+                continue
+
+            finding = {"external_url": url, "ids": [g["id"] for g in groups], "diff": [], "body": new_txn}
+            if new_txn is None:
+                # Reported as failed already
+                if getExpenseUrl(url) not in failed:
+                    yield {**finding, "kind": "orphaned", "deleted": getExpenseUrl(url) in deleted}
+            elif not groups:
+                yield {**finding, "kind": "missing"}
+            else:
+                if len(groups) > 1:
+                    yield {**finding, "kind": "duplicated"}
+                if diff := getTransactionDiff(new_txn, groups[0]):
+                    yield {**finding, "kind": "drifted", "diff": diff}
+
+
+def getFixOperations(finding: dict) -> list[dict]:
+    """
+    Get the Firefly operations that resolve an audit finding.
+    :param finding: A finding from auditTransactions
+    :return: A list of operations, dictionaries with "op" (add, update or delete), "external_url", and "id" and "body" where needed.
+        Empty for failed findings, and for orphans whose expense still exists on Splitwise but is no longer synced, e.g.
+        because its Firefly comment is gone, since deleting those could lose data.
+    """
+    url, ids, body = finding["external_url"], finding["ids"], finding["body"]
+    if finding["kind"] == "failed" or (finding["kind"] == "orphaned" and not finding["deleted"]):
+        return []
+    if finding["kind"] == "missing":
+        return [{"op": "add", "external_url": url, "body": body}]
+    if finding["kind"] == "drifted":
+        return [{"op": "update", "external_url": url, "id": ids[0], "body": body}]
+    if finding["kind"] == "duplicated":
+        return [{"op": "delete", "external_url": url, "id": i} for i in ids[1:]]
+    return [{"op": "delete", "external_url": url, "id": i} for i in ids]
+
+
+def runAudit(sw: Splitwise, user: User, since: datetime, window_days: int, fix_plan: str = None) -> dict[str, int]:
+    """
+    Report the differences between Splitwise and Firefly, and optionally write the operations to fix them.
+    :param sw: A Splitwise object
+    :param user: A Splitwise User object for whom to get expenses
+    :param since: Start of the range to audit, up to now
+    :param window_days: Length of each audit window in days
+    :param fix_plan: Path to write the fix operations to, one JSON object per line. If None, no plan is written.
+    :return: A dictionary of the number of findings by kind
+    """
+    counts = {"missing": 0, "orphaned": 0, "duplicated": 0, "drifted": 0, "failed": 0}
+    comment_cache.update(loadCommentCache(conf["SPLITWISE_COMMENT_CACHE"]))
+    if fix_plan:
+        # Drops the applied log of a previous plan at the same path
+        PlanFile(fix_plan).write([])
+    plan = open(fix_plan, "w") if fix_plan else None
+    try:
+        for finding in auditTransactions(sw, user, since, time_now, window_days):
+            counts[finding["kind"]] += 1
+            ids = ",".join(finding["ids"])
+            detail = finding.get("error") or ("deleted on Splitwise" if finding.get("deleted") else "")
+            logger.warning("%s: %s ids=[%s] diff=%s %s", finding["kind"].capitalize(), finding["external_url"], ids, finding["diff"],
+                           detail, extra={"kind": finding["kind"], "external_url": finding["external_url"]})
+            if plan:
+                for op in getFixOperations(finding):
+                    plan.write(json.dumps(op) + "\n")
+    finally:
+        if plan:
+            plan.close()
+        saveCommentCache(conf["SPLITWISE_COMMENT_CACHE"], comment_cache)
+    logger.info("Audit: %s", counts)
+    return counts
+
+
+def runSync(sw: Splitwise, user: User) -> None:
+    """
+    Get Splitwise expenses after SPLITWISE_DAYS ago and process them - update or add transactions on Firefly.
+    :param sw: A Splitwise object
+    :param user: A Splitwise User object for whom to get expenses
+    :return: None
+    """
+    global sync_deadline
+    if conf["SYNC_BUDGET_SECONDS"]:
+        sync_deadline = time.monotonic() + conf["SYNC_BUDGET_SECONDS"]
+    past_day = time_now - timedelta(days=conf["SPLITWISE_DAYS"])
+    logger.info("From: %s", past_day)
+
+    # Spooled writes go first, so that the search below sees them
+    flushSpool()
+    txns = getTransactionsAfter(past_day)
+    account_index.update(getAccountIndex())
+
+    comment_cache.update(loadCommentCache(conf["SPLITWISE_COMMENT_CACHE"]))
+
+    # Fetching (with comments), building transaction bodies, creating accounts and writing to Firefly run as separate stages
+    try:
+        Pipeline(conf["SYNC_QUEUE_SIZE"]) \
+            .stage(lambda e: getExpenseTransactions(*e), conf["SYNC_TRANSFORM_WORKERS"]) \
+            .stage(createExpenseAccounts) \
+            .stage(lambda t: writeExpenseTransactions(past_day, txns, *t), conf["SYNC_WRITE_WORKERS"]) \
+            .run(getExpensesAfter(sw, past_day, user, loadRemainder(conf["SYNC_REMAINDER"])))
+    finally:
+        saveCommentCache(conf["SPLITWISE_COMMENT_CACHE"], comment_cache)
+    # Only on a clean finish, a failed run is retried in full anyway
+    saveRemainder(conf["SYNC_REMAINDER"], sync_remainder)
+    if sync_remainder:
+        logger.warning("Sync budget ran out, %d expenses left for the next run", len(sync_remainder))
+
+
+def runPlan(sw: Splitwise, user: User, path: str) -> dict[str, int]:
+    """
+    Plan the sync of Splitwise expenses after SPLITWISE_DAYS ago without writing to Firefly, see runApply.
+    :param sw: A Splitwise object
+    :param user: A Splitwise User object for whom to get expenses
+    :param path: Path to write the plan to, one JSON operation per line
+    :return: A dictionary of the number of operations by kind, and the estimated Firefly API "calls"
     """
     past_day = time_now - timedelta(days=conf["SPLITWISE_DAYS"])
+    logger.info("From: %s", past_day)
 
     txns = getTransactionsAfter(past_day)
+    account_index.update(getAccountIndex())
+    comment_cache.update(loadCommentCache(conf["SPLITWISE_COMMENT_CACHE"]))
+
+    ops: list[dict] = []
+    planned_accounts = set()
+    try:
+        for e in getExpensesAfter(sw, past_day, user, loadRemainder(conf["SYNC_REMAINDER"])):
+            exp, new_txns = getExpenseTransactions(*e)
+            for key, account in getMissingAccounts(new_txns).items():
+                if key not in planned_accounts:
+                    planned_accounts.add(key)
+                    ops.append({"op": "account", "body": account, "calls": 1})
+            ops.extend(planExpenseTransactions(past_day, txns, exp, new_txns))
+    finally:
+        saveCommentCache(conf["SPLITWISE_COMMENT_CACHE"], comment_cache)
+
+    PlanFile(path).write(ops)
+    counts = {"account": 0, "add": 0, "update": 0, "lookup": 0, "skip": 0, "calls": 0}
+    for op in ops:
+        counts[op["op"]] += 1
+        counts["calls"] += op["calls"]
+    logger.info("Plan: %s", counts)
+    return counts
+
+
+def runApply(path: str) -> dict[str, int]:
+    """
+    Apply a plan from runPlan, or an audit fix plan, on Firefly.
+
+    Accounts are created first, then the transactions are written with SYNC_WRITE_WORKERS threads. Operations are
+    recorded as applied as they finish, so an interrupted apply can be run again and resumes where it stopped. Only
+    the failed operations are left in the plan at the end.
 
-    sw = Splitwise("", "", api_key=conf["SPLITWISE_TOKEN"])
-    currentUser = sw.getCurrentUser()
-    print(f"User: {currentUser.getFirstName()}")
-    print(f"From: {past_day}")
+    :param path: Path of the plan
+    :return: A dictionary of the number of "applied" and "failed" operations
+    """
+    flushSpool()
+    plan = PlanFile(path)
+    ops = [op for op in plan.load() if op["op"] != "skip"]
+    logger.info("Applying %d operations, estimated %d Firefly calls", len(ops), sum(op.get("calls", 1) for op in ops))
 
-    for e in getExpensesAfter(sw, past_day, currentUser):
-        processExpense(past_day, txns, *e)
+    def apply(op: dict) -> Optional[dict]:
+        try:
+            # Updates modify the old group in place, the log needs the operation as planned
+            applyOperation(copy.deepcopy(op))
+        except Exception as e:
+            logger.error("Operation %s failed: %s, e: %s", op["op"], op.get("external_url") or op["body"], e)
+            return op
+        if not conf["FIREFLY_DRY_RUN"]:
+            plan.applied(op)
+        return None
+
+    # Created up front, so that concurrent writes do not race to auto-create them
+    failed = [op for op in map(apply, [op for op in ops if op["op"] == "account"]) if op]
+    with ThreadPoolExecutor(max(1, conf["SYNC_WRITE_WORKERS"])) as executor:
+        failed += [op for op in executor.map(apply, [op for op in ops if op["op"] != "account"]) if op]
+    if not conf["FIREFLY_DRY_RUN"]:
+        plan.write(failed)
+    counts = {"applied": len(ops) - len(failed), "failed": len(failed)}
+    logger.info("Apply: %s", counts)
+    return counts
+
+
+# Functions profiled per sync stage with --profile
+PROFILE_STAGES = {
+    "fetch": ["fetchExpenses"],
+    "comments": ["getCommentData"],
+    "strategy": ["getExpenseTransactions"],
+    "search": ["searchTransactions"],
+    "write": ["addTransaction", "updateTransaction"],
+}
 
-    print("Complete")
+
+if __name__ == "__main__":
+    """
+    Main function. Sync Splitwise expenses to Firefly, plan and apply a sync, or audit Firefly against Splitwise.
+    """
+    parser = argparse.ArgumentParser(description="Sync Splitwise expenses to Firefly III.")
+    parser.add_argument("command", nargs="?", default="sync", choices=["sync", "plan", "apply", "audit"],
+                        help="sync recent expenses (default), plan a sync to a file, apply a plan, or audit Firefly against Splitwise")
+    parser.add_argument("--since", type=lambda d: datetime.fromisoformat(d).astimezone(),
+                        default=time_now - timedelta(days=365), help="audit: start date (ISO 8601), defaults to a year ago")
+    parser.add_argument("--window-days", type=int, default=30, help="audit: days loaded at a time")
+    parser.add_argument("--fix-plan", help="audit: write the operations that fix the findings to this file")
+    parser.add_argument("--plan", default="sync-plan.jsonl", help="plan/apply: the plan file")
+    parser.add_argument("--profile", metavar="DIR", help="write cProfile stats and top allocations per stage to DIR")
+    parser.add_argument("--profile-sample-rate", type=float, default=1.0,
+                        help="fraction of stage calls to profile, lower it for long-running syncs")
+    args = parser.parse_args()
+
+    log_listener = setupLogging(conf["LOG_LEVEL"], conf["LOG_FORMAT"])
+    atexit.register(log_listener.stop)
+
+    profiler = None
+    if args.profile:
+        profiler = Profiler(args.profile, args.profile_sample_rate).start()
+        for stage, names in PROFILE_STAGES.items():
+            for name in names:
+                globals()[name] = profiler.wrap(stage, globals()[name])
+
+    try:
+        # Apply only talks to Firefly
+        if args.command == "apply":
+            runApply(args.plan)
+        else:
+            sw = PooledSplitwise("", "", api_key=conf["SPLITWISE_TOKEN"],
+                                 pool_size=conf["SPLITWISE_POOL_SIZE"],
+                                 timeout=conf["SPLITWISE_TIMEOUT"],
+                                 retries=conf["SPLITWISE_RETRIES"],
+                                 user_cache=conf["SPLITWISE_USER_CACHE"])
+            currentUser = sw.getCurrentUser()
+            logger.info("User: %s", currentUser.getFirstName())
+
+            if args.command == "audit":
+                runAudit(sw, currentUser, args.since, args.window_days, args.fix_plan)
+            elif args.command == "plan":
+                runPlan(sw, currentUser, args.plan)
+            else:
+                runSync(sw, currentUser)
+    finally:
+        if profiler:
+            profiler.report()
+
+    logger.info("Complete")
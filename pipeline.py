@@ -0,0 +1,111 @@
+import queue
+import threading
+from typing import Any, Callable, Iterable, Optional
+
+# Marks the end of the items in a queue, one per consumer
+_DONE = object()
+
+
+class Pipeline:
+    def __init__(self, queue_size: int = 10) -> None:
+        """
+        Initialize a Pipeline of stages connected by bounded queues.
+
+        Each stage runs in its own worker threads. A full queue blocks the stage feeding it, so a slow stage applies
+        backpressure upstream and at most queue_size items wait between any two stages.
+
+        :param queue_size: Maximum number of items waiting between two stages
+        """
+        self._queue_size = queue_size
+        self._stages: list[tuple[Callable[[Any], Any], int]] = []
+        self._failed = threading.Event()
+        self._error: Optional[BaseException] = None
+        self._lock = threading.Lock()
+
+    def stage(self, fn: Callable[[Any], Any], workers: int = 1) -> "Pipeline":
+        """
+        Add a stage to the pipeline.
+
+        :param fn: Function called with each item from the previous stage. Its return value is passed to the next stage, unless it is None.
+        :param workers: Number of threads running this stage concurrently. Items are processed in order only with a single worker.
+        :return: The pipeline itself, to chain stages
+        """
+        self._stages.append((fn, max(1, workers)))
+        return self
+
+    def _fail(self, e: BaseException) -> None:
+        with self._lock:
+            if self._error is None:
+                self._error = e
+        self._failed.set()
+
+    def _put(self, q: queue.Queue, item: Any) -> bool:
+        while not self._failed.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q: queue.Queue) -> Any:
+        while not self._failed.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def run(self, source: Iterable) -> None:
+        """
+        Feed the items of source through all stages and wait for them to finish.
+
+        :param source: An iterable of items for the first stage. It is consumed in its own thread.
+        :return: None
+        :raises: The first exception raised by the source or any stage. The remaining work is abandoned.
+        """
+        queues = [queue.Queue(self._queue_size) for _ in self._stages]
+        remaining = [workers for _, workers in self._stages]
+
+        def finish(i: int) -> None:
+            # The last worker of a stage tells every worker of the next stage to stop
+            if i < len(self._stages):
+                for _ in range(self._stages[i][1]):
+                    self._put(queues[i], _DONE)
+
+        def produce() -> None:
+            try:
+                for item in source:
+                    if not self._put(queues[0], item):
+                        return
+            except BaseException as e:
+                self._fail(e)
+            finally:
+                finish(0)
+
+        def work(i: int) -> None:
+            fn = self._stages[i][0]
+            try:
+                while (item := self._get(queues[i])) is not _DONE:
+                    out = fn(item)
+                    if i + 1 < len(self._stages) and out is not None and not self._put(queues[i + 1], out):
+                        return
+            except BaseException as e:
+                self._fail(e)
+            finally:
+                with self._lock:
+                    remaining[i] -= 1
+                    last = remaining[i] == 0
+                if last:
+                    finish(i + 1)
+
+        threads = [threading.Thread(target=produce, name="pipeline-source", daemon=True)]
+        for i, (_, workers) in enumerate(self._stages):
+            threads.extend(threading.Thread(target=work, args=(i,), name=f"pipeline-{i}-{w}", daemon=True) for w in range(workers))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        if self._error is not None:
+            raise self._error
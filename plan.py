@@ -0,0 +1,70 @@
+import hashlib
+import json
+import os
+import threading
+
+
+class PlanFile:
+    def __init__(self, path: str) -> None:
+        """
+        Initialize a file of planned Firefly operations, one JSON object per line.
+
+        Applied operations are appended to a log next to the plan as they finish, so an interrupted apply resumes
+        after the last applied operation instead of sending it again.
+
+        :param path: Path of the plan file. The log is kept at "<path>.applied".
+        """
+        self._path = path
+        self._log = f"{path}.applied"
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(line: str) -> str:
+        return hashlib.sha256(line.encode()).hexdigest()
+
+    def write(self, ops: list[dict]) -> None:
+        """
+        Write a new plan, replacing any previous plan and its log.
+
+        :param ops: A list of operation dictionaries. If empty, the plan file is removed.
+        :return: None
+        """
+        with self._lock:
+            if ops:
+                tmp = f"{self._path}.tmp"
+                with open(tmp, "w") as f:
+                    f.writelines(json.dumps(op) + "\n" for op in ops)
+                os.replace(tmp, self._path)
+            elif os.path.exists(self._path):
+                os.remove(self._path)
+            if os.path.exists(self._log):
+                os.remove(self._log)
+
+    def load(self) -> list[dict]:
+        """
+        Load the operations not applied yet.
+
+        :return: A list of operation dictionaries, in plan order. Empty if there is no plan.
+        """
+        with self._lock:
+            try:
+                with open(self._log) as f:
+                    applied = {line.strip() for line in f}
+            except FileNotFoundError:
+                applied = set()
+            try:
+                with open(self._path) as f:
+                    return [json.loads(line) for line in f if line.strip() and self._key(line.strip()) not in applied]
+            except FileNotFoundError:
+                return []
+
+    def applied(self, op: dict) -> None:
+        """
+        Record an operation as applied, before the next one is sent.
+
+        :param op: An operation dictionary as returned by load
+        :return: None
+        """
+        with self._lock, open(self._log, "a") as f:
+            f.write(self._key(json.dumps(op)) + "\n")
+            f.flush()
@@ -0,0 +1,141 @@
+import cProfile
+import logging
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from functools import wraps
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+
+# Before Python 3.12 cProfile hooks each thread separately, so every thread can run its own profiler.
+# Since then only one profiler can be active per interpreter, and it records the calls of all threads.
+CONCURRENT_PROFILES = sys.version_info < (3, 12)
+
+
+class Profiler:
+    def __init__(self, output_dir: str, sample_rate: float = 1.0, top: int = 25) -> None:
+        """
+        Initialize a Profiler that collects cProfile stats and tracemalloc allocations per sync stage.
+
+        Before Python 3.12 each thread profiles its own sampled calls, merged per stage in the report. Since then
+        cProfile can only be enabled once per interpreter and records every thread, so sampled calls wait for each
+        other, and a stage's stats also include whatever other threads ran meanwhile, like unsampled calls of other
+        stages. Memory allocations are only traced while a sampled call runs, so unsampled calls run at full speed.
+        Allocations of concurrent sampled calls can be attributed to each other's stages.
+
+        :param output_dir: Directory to write the reports to
+        :param sample_rate: Fraction of stage calls to profile, between 0 and 1
+        :param top: Number of allocation sites listed per stage
+        """
+        self._output_dir = output_dir
+        self._sample_rate = sample_rate
+        self._top = top
+        # Guards the shared state below, never held during a call
+        self._lock = threading.Lock()
+        # Held during sampled calls if profiles cannot run concurrently
+        self._serial = threading.Lock()
+        self._local = threading.local()
+        self._profiles: dict[str, list[cProfile.Profile]] = defaultdict(list)
+        self._allocations: dict[str, Counter] = defaultdict(Counter)
+        self._calls: Counter = Counter()
+        self._sampled: Counter = Counter()
+        self._elapsed: Counter = Counter()
+        self._tracing = 0
+
+    def start(self) -> "Profiler":
+        """
+        Start profiling. Memory allocations are traced from the first sampled call on.
+
+        :return: The profiler itself
+        """
+        return self
+
+    def _profile(self, stage: str) -> cProfile.Profile:
+        # One profile per thread and stage
+        profiles = self._local.__dict__.setdefault("profiles", {})
+        if stage not in profiles:
+            profiles[stage] = cProfile.Profile()
+            with self._lock:
+                self._profiles[stage].append(profiles[stage])
+        return profiles[stage]
+
+    def _trace(self, delta: int) -> None:
+        # Traces allocations while at least one sampled call runs
+        with self._lock:
+            self._tracing += delta
+            if delta > 0 and not tracemalloc.is_tracing():
+                tracemalloc.start()
+            elif not self._tracing:
+                tracemalloc.stop()
+
+    def _sample(self, stage: str, fn: Callable, *args, **kwargs):
+        self._local.active = True
+        self._trace(1)
+        try:
+            before = tracemalloc.take_snapshot()
+            profile = self._profile(stage)
+            profile.enable()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                profile.disable()
+                after = tracemalloc.take_snapshot()
+                with self._lock:
+                    self._sampled[stage] += 1
+                    for diff in after.compare_to(before, "lineno"):
+                        if diff.size_diff > 0:
+                            self._allocations[stage][str(diff.traceback)] += diff.size_diff
+        finally:
+            self._trace(-1)
+            self._local.active = False
+
+    def wrap(self, stage: str, fn: Callable) -> Callable:
+        """
+        Wrap a function so that its calls are attributed to a stage.
+
+        :param stage: Name of the stage, e.g. fetch, comments, strategy, search or write
+        :param fn: The function to wrap
+        :return: The wrapped function
+        """
+        @wraps(fn)
+        def profiled(*args, **kwargs):
+            # Calls from within a profiled call belong to the outer stage
+            if getattr(self._local, "active", False):
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                if random.random() >= self._sample_rate:
+                    return fn(*args, **kwargs)
+                if CONCURRENT_PROFILES:
+                    return self._sample(stage, fn, *args, **kwargs)
+                with self._serial:
+                    return self._sample(stage, fn, *args, **kwargs)
+            finally:
+                with self._lock:
+                    self._calls[stage] += 1
+                    self._elapsed[stage] += time.perf_counter() - start
+
+        return profiled
+
+    def report(self) -> None:
+        """
+        Write <stage>.pstats and <stage>.alloc.txt for each stage to the output directory, and print a summary.
+
+        :return: None
+        """
+        os.makedirs(self._output_dir, exist_ok=True)
+        for stage in sorted(self._calls):
+            if self._sampled[stage]:
+                path = os.path.join(self._output_dir, f"{stage}.pstats")
+                pstats.Stats(*self._profiles[stage]).dump_stats(path)
+            with open(os.path.join(self._output_dir, f"{stage}.alloc.txt"), "w") as f:
+                for site, size in self._allocations[stage].most_common(self._top):
+                    f.write(f"{size / 1024:10.1f} KiB  {site}\n")
+            logger.info("Profile %s: %d calls, %d sampled, %.3fs", stage, self._calls[stage], self._sampled[stage], self._elapsed[stage])
@@ -0,0 +1,97 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from splitwise import Splitwise
+from splitwise.exception import (SplitwiseBadRequestException, SplitwiseException, SplitwiseNotAllowedException,
+                                 SplitwiseNotFoundException, SplitwiseUnauthorizedException)
+from splitwise.user import CurrentUser
+from urllib3.util.retry import Retry
+
+
+class PooledSplitwise(Splitwise):
+    def __init__(self, consumer_key, consumer_secret, api_key=None, pool_size: int = 4, timeout: float = 30,
+                 retries: int = 3, backoff: float = 0.5, user_cache: str = "", user_cache_ttl: float = 86400, **kwargs) -> None:
+        """
+        Initialize a Splitwise client that reuses connections and retries transient errors.
+
+        The SDK opens a new session, and so a new connection, for every request and waits forever. This client sends
+        all requests through one session with a keep-alive pool, a timeout, and retries with exponential backoff for
+        connection errors, 429 and 5xx responses on GET requests.
+
+        :param consumer_key: Splitwise consumer key, as for Splitwise
+        :param consumer_secret: Splitwise consumer secret, as for Splitwise
+        :param api_key: Splitwise API key, as for Splitwise
+        :param pool_size: Number of connections kept alive, should match the number of concurrent requests
+        :param timeout: Seconds to wait for Splitwise to connect and to respond
+        :param retries: Number of retries for a failed GET request
+        :param backoff: Backoff factor in seconds between retries, doubled for every retry
+        :param user_cache: Path to cache the current user in across runs. If empty, the user is fetched every run.
+        :param user_cache_ttl: Seconds the cached current user is used for
+        """
+        super().__init__(consumer_key, consumer_secret, api_key=api_key, **kwargs)
+        self._timeout = timeout
+        self._user_cache = user_cache
+        self._user_cache_ttl = user_cache_ttl
+        self._session = requests.Session()
+        retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=frozenset(["GET"]), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+        self._user_lock = threading.Lock()
+
+    def _Splitwise__makeRequest(self, url, method="GET", data=None, auth=None, files=None):
+        # Replaces the SDK's private request method, keeping its authentication and error handling
+        headers = {}
+        if auth is None:
+            if self.auth:
+                auth = self.auth
+            elif self.api_key:
+                headers = {'Authorization': 'Bearer {}'.format(self.api_key)}
+
+        prep_req = requests.Request(method=method, url=url, headers=headers, data=data, auth=auth, files=files).prepare()
+        response = self._session.send(prep_req, timeout=self._timeout)
+
+        if response.status_code == 200:
+            if response.content and hasattr(response.content, "decode"):
+                return response.content.decode("utf-8")
+            return response.content
+        if response.status_code == 401:
+            raise SplitwiseUnauthorizedException("Please check your token or consumer id and secret", response=response)
+        if response.status_code == 403:
+            raise SplitwiseNotAllowedException("You are not allowed to perform this operation", response=response)
+        if response.status_code == 400:
+            raise SplitwiseBadRequestException("Please check your request", response=response)
+        if response.status_code == 404:
+            raise SplitwiseNotFoundException("Required resource is not found", response)
+        raise SplitwiseException("Unknown error happened", response)
+
+    def getCurrentUser(self) -> CurrentUser:
+        """
+        Get the current user, from the user cache if it is fresh and for the same API key.
+
+        :return: CurrentUser object containing user data
+        """
+        key = hashlib.sha256(str(self.api_key or self.consumer_key).encode()).hexdigest()
+        with self._user_lock:
+            if self._user_cache:
+                try:
+                    with open(self._user_cache) as f:
+                        cached = json.load(f)
+                    if cached["key"] == key and time.time() - cached["stored_at"] < self._user_cache_ttl:
+                        return CurrentUser(cached["user"])
+                except (OSError, ValueError, KeyError):
+                    pass
+
+            content = json.loads(self._Splitwise__makeRequest(Splitwise.GET_CURRENT_USER_URL))
+            if self._user_cache:
+                tmp = f"{self._user_cache}.tmp"
+                with open(tmp, "w") as f:
+                    json.dump({"key": key, "stored_at": time.time(), "user": content["user"]}, f)
+                os.replace(tmp, self._user_cache)
+            return CurrentUser(content["user"])
@@ -0,0 +1,62 @@
+import json
+import os
+import threading
+
+
+class WriteSpool:
+    def __init__(self, path: str) -> None:
+        """
+        Initialize a durable on-disk spool of Firefly write requests.
+
+        Requests are appended as JSON lines and synced to disk, so they survive the process exiting before Firefly is
+        reachable again.
+
+        :param path: Path of the spool file
+        """
+        self._path = path
+        self._lock = threading.Lock()
+
+    def append(self, entry: dict) -> None:
+        """
+        Append a request to the spool.
+
+        :param entry: A dictionary with the "method", "path" and "body" of the request
+        :return: None
+        """
+        line = json.dumps(entry) + "\n"
+        with self._lock, open(self._path, "a") as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def load(self) -> list[dict]:
+        """
+        Load the spooled requests, oldest first.
+
+        :return: A list of request dictionaries. Empty if nothing is spooled.
+        """
+        with self._lock:
+            try:
+                with open(self._path) as f:
+                    return [json.loads(line) for line in f if line.strip()]
+            except FileNotFoundError:
+                return []
+
+    def replace(self, entries: list[dict]) -> None:
+        """
+        Replace the spooled requests, e.g. with the ones left after a flush.
+
+        :param entries: A list of request dictionaries. If empty, the spool file is removed.
+        :return: None
+        """
+        with self._lock:
+            if not entries:
+                if os.path.exists(self._path):
+                    os.remove(self._path)
+                return
+            tmp = f"{self._path}.tmp"
+            with open(tmp, "w") as f:
+                f.writelines(json.dumps(entry) + "\n" for entry in entries)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self._path)
@@ -1,6 +1,7 @@
 import pytest
-from unittest.mock import patch, Mock
+from unittest.mock import patch, Mock, MagicMock
 import importlib
+import logging
 import requests
 
 # Mock the entire requests library
@@ -74,5 +75,80 @@ def test_cache_behavior(mock_requests):
     # The request should only be made once due to caching
     assert call_count == 1
 
+def test_getAccounts_pagination(mock_requests):
+    def mock_request(method, url, params, **kwargs):
+        page = params.get('page', 1)
+        mock_response = Mock()
+        mock_response.json.return_value = {
+            'data': [{'attributes': {'name': f'Account{page}', 'currency_code': 'USD'}}],
+            'meta': {'pagination': {'total_pages': 3}},
+        }
+        return mock_response
+    mock_requests.side_effect = mock_request
+
+    main = reload_main()
+    mock_requests.reset_mock()
+    result = main.getAccounts("expense")
+
+    assert [a['attributes']['name'] for a in result] == ['Account1', 'Account2', 'Account3']
+    assert mock_requests.call_count == 3
+
+def test_createMissingAccounts(mock_requests):
+    main = reload_main()
+    mock_requests.return_value.json.return_value = {
+        'data': [{'attributes': {'name': 'Groceries  Store', 'type': 'expense', 'currency_code': 'USD'}}]
+    }
+    with patch.dict('main.account_index', main.getAccountIndex(["expense"]), clear=True), \
+         patch.dict('main.conf', {'FIREFLY_DRY_RUN': False}):
+        mock_requests.reset_mock()
+        txns = [
+            {"type": "withdrawal", "source_name": "Amex", "destination_name": "groceries store"},
+            [{"type": "withdrawal", "source_name": "Amex", "destination_name": "Cafe"},
+             {"type": "deposit", "source_name": "SW balancer", "destination_name": "SW"}],
+            {"type": "withdrawal", "source_name": "Amex", "destination_name": "CAFE"},
+        ]
+        created = main.createMissingAccounts(txns)
+
+        assert created == [{"name": "Cafe", "type": "expense"}, {"name": "SW balancer", "type": "revenue"}]
+        assert mock_requests.call_count == 2
+        assert mock_requests.call_args.kwargs['json'] == {"name": "SW balancer", "type": "revenue"}
+        # Created accounts are indexed, nothing is created twice
+        assert main.createMissingAccounts(txns) == []
+
+def test_createMissingAccounts_dry_run(mock_requests, caplog):
+    main = reload_main()
+    txns = [{"type": "withdrawal", "source_name": "Amex", "destination_name": "Cafe"}]
+    with patch.dict('main.account_index', clear=True), patch.dict('main.conf', {'FIREFLY_DRY_RUN': True}), \
+         caplog.at_level(logging.INFO, logger="main"):
+        mock_requests.reset_mock()
+        assert main.createMissingAccounts(txns) == []
+    mock_requests.assert_not_called()
+    assert "Created" not in caplog.text
+
+def test_createMissingAccounts_unavailable(mock_requests):
+    main = reload_main()
+    txns = [{"type": "withdrawal", "source_name": "Amex", "destination_name": "Cafe"}]
+    with patch.dict('main.account_index', clear=True), patch.dict('main.conf', {'FIREFLY_DRY_RUN': False}):
+        mock_requests.reset_mock()
+        mock_requests.side_effect = requests.ConnectionError("refused")
+        assert main.createMissingAccounts(txns) == []
+        # Not marked as created, so a later batch tries again
+        assert main.account_index == {}
+    assert mock_requests.call_count == 1
+
+    mock_requests.side_effect = requests.HTTPError(response=MagicMock(status_code=422))
+    with patch.dict('main.account_index', clear=True), patch.dict('main.conf', {'FIREFLY_DRY_RUN': False}), \
+         pytest.raises(requests.HTTPError):
+        main.createMissingAccounts(txns)
+
+def test_createExpenseAccounts_past_deadline(mock_requests):
+    main = reload_main()
+    item = (MagicMock(), [{"type": "withdrawal", "source_name": "Amex", "destination_name": "Cafe"}])
+    with patch.dict('main.account_index', clear=True), patch.dict('main.conf', {'FIREFLY_DRY_RUN': False}), \
+         patch('main.isPastDeadline', return_value=True):
+        mock_requests.reset_mock()
+        assert main.createExpenseAccounts(item) is item
+    mock_requests.assert_not_called()
+
 if __name__ == "__main__":
     pytest.main([__file__])
\ No newline at end of file
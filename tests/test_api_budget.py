@@ -0,0 +1,290 @@
+import json
+import pytest
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from splitwise import Expense, User
+from splitwise.user import ExpenseUser
+from unittest.mock import MagicMock, patch
+import requests
+
+# Budgets of API calls per synced expense, on top of the fixed cost of a run
+SPLITWISE_COMMENTS_PER_EXPENSE = 1
+FIREFLY_WRITES_PER_TRANSACTION = 1
+FIREFLY_SEARCHES_PER_OLD_EXPENSE = 1
+# Fixed cost of a run: one page of the sync window search, one page per account type
+FIREFLY_STARTUP_GETS = 1 + 3
+SPLITWISE_PAGE_SIZE = 20
+
+N = 5
+
+@pytest.fixture(autouse=True)
+def mock_requests():
+    with patch('requests.request') as mock:
+        mock.return_value.json.return_value = {'data': []}
+        yield mock
+
+def load_main():
+    import main
+    return main
+
+
+class FakeFirefly:
+    def __init__(self, groups: list[dict], account_names: list[str], in_window: bool = True) -> None:
+        self.groups = groups
+        # Whether the groups are returned by the sync window search, or only by external URL
+        self.in_window = in_window
+        self.account_names = account_names
+        self.calls = Counter()
+
+    def __call__(self, method, url, headers=None, params=None, json=None, timeout=None):
+        path = url.split("/api/v1/")[1].strip("/")
+        self.calls[f"{method} {path.split('/')[0]}"] += 1
+        if method == "GET" and path == "search/transactions":
+            query = params["query"]
+            if "external_url_is" in query:
+                data = [g for g in self.groups if f'"{g["attributes"]["transactions"][0]["external_url"]}"' in query]
+            else:
+                data = self.groups if self.in_window else []
+            content = {"data": data, "meta": {"pagination": {"total_pages": 1}}}
+        elif method == "GET" and path == "accounts":
+            data = [{"attributes": {"name": name, "currency_code": "USD"}} for name in self.account_names]
+            content = {"data": data, "meta": {"pagination": {"total_pages": 1}}}
+        else:
+            content = {"data": {"id": "1", "attributes": {"transactions": []}}}
+        res = requests.Response()
+        res.status_code, res._content = 200, _json(content)
+        return res
+
+    @property
+    def writes(self) -> int:
+        return sum(count for call, count in self.calls.items() if not call.startswith("GET"))
+
+
+def _json(content) -> bytes:
+    return json.dumps(content).encode()
+
+
+@pytest.fixture
+def user():
+    user = MagicMock(spec=User)
+    user.getId.return_value = "12345"
+    return user
+
+def make_expenses(created_days_ago: int = 0, paid: str = "0.0") -> list[Expense]:
+    now = datetime.now().astimezone()
+    expenses = []
+    for i in range(N):
+        myshare = MagicMock(spec=ExpenseUser)
+        myshare.getId.return_value = "12345"
+        myshare.getOwedShare.return_value = "10.0"
+        myshare.getPaidShare.return_value = paid
+        myshare.getNetBalance.return_value = str(float(paid) - 10.0)
+        exp = MagicMock(spec=Expense)
+        exp.getId.return_value = i
+        exp.getDescription.return_value = f"Expense {i}"
+        exp.getCurrencyCode.return_value = "USD"
+        exp.getDate.return_value = (now - timedelta(days=created_days_ago)).isoformat()
+        exp.getCreatedAt.return_value = (now - timedelta(days=created_days_ago)).isoformat()
+        exp.getUpdatedAt.return_value = now.isoformat()
+        exp.getCommentsCount.return_value = 0
+        exp.getDetails.return_value = "firefly"
+        exp.getDeletedAt.return_value = None
+        exp.getPayment.return_value = False
+        exp.getUpdatedBy.return_value = None
+        exp.getCreatedBy.return_value = MagicMock(getId=MagicMock(return_value="12345"))
+        exp.getCategory.return_value = MagicMock(getName=MagicMock(return_value="General"))
+        exp.getUsers.return_value = [myshare]
+        expenses.append(exp)
+    return expenses
+
+def firefly_split(split: dict) -> dict:
+    """Shape a submitted split the way Firefly returns it."""
+    stored = {}
+    for k, v in split.items():
+        if v in ("", [], None):
+            # Null for fields submitted empty
+            stored[k] = None
+        elif k in ("amount", "foreign_amount"):
+            stored[k] = f"{float(v):.12f}"
+        elif k in ("date", "payment_date"):
+            # Stored with the server's timezone
+            stored[k] = datetime.fromisoformat(v).astimezone(timezone(timedelta(hours=2))).isoformat()
+        else:
+            stored[k] = v
+    return stored
+
+def make_groups(main, expenses: list[Expense]) -> list[dict]:
+    groups = []
+    for exp in expenses:
+        with patch('main.getAccountCurrencyCode', return_value="USD"):
+            _, new_txns = main.getExpenseTransactions(exp, exp.getUsers()[0], [])
+        for new_txn in new_txns:
+            splits = [new_txn] if isinstance(new_txn, dict) else new_txn
+            groups.append({"id": str(len(groups)), "attributes": {"transactions": [firefly_split(json.loads(json.dumps(t))) for t in splits]}})
+    return groups
+
+def run_sync(main, user, expenses, groups=[], currency="USD", warm_comments=False, in_window=True, run=None):
+    firefly = FakeFirefly(groups, [exp.getDescription() for exp in expenses], in_window)
+    sw = MagicMock()
+    sw.getExpenses.side_effect = [expenses[i:i + SPLITWISE_PAGE_SIZE] for i in range(0, len(expenses), SPLITWISE_PAGE_SIZE)] + [[]]
+    sw.getComments.return_value = []
+    comments = {str(exp.getId()): {"stamp": [exp.getUpdatedAt(), 0], "data": []} for exp in expenses} if warm_comments else {}
+    with patch('requests.request', firefly), \
+         patch('main.getAccountCurrencyCode', return_value=currency), \
+         patch.dict('main.txn_hashes', clear=True), \
+         patch.dict('main.account_index', clear=True), \
+         patch.dict('main.comment_cache', comments, clear=True):
+        (run or main.runSync)(sw, user)
+    return firefly, sw
+
+@pytest.fixture
+def main():
+    main = load_main()
+    with patch.dict('main.conf', {
+        'FIREFLY_DRY_RUN': False,
+        'SW_BALANCE_ACCOUNT': '',
+        'SPLITWISE_DAYS': 7,
+        'SPLITWISE_SHARD_WORKERS': 0,
+        'SPLITWISE_COMMENT_CACHE': '',
+        'SYNC_BUDGET_SECONDS': 0,
+        'SYNC_REMAINDER': '',
+        'FOREIGN_CURRENCY_TOFIX_TAG': 'fixme/foreign-currency',
+    }), patch('main.write_spool', None), patch('main.response_cache', None):
+        yield main
+
+def assert_splitwise_budget(sw, comments_per_expense=SPLITWISE_COMMENTS_PER_EXPENSE):
+    assert sw.getExpenses.call_count <= N // SPLITWISE_PAGE_SIZE + 2
+    assert sw.getComments.call_count <= comments_per_expense * N
+
+def assert_startup_budget(firefly, searches=0):
+    assert firefly.calls["GET search"] <= 1 + searches
+    assert firefly.calls["GET accounts"] <= FIREFLY_STARTUP_GETS - 1
+    assert firefly.calls["POST accounts"] == 0
+
+def test_budget_all_new(main, user):
+    firefly, sw = run_sync(main, user, make_expenses())
+    assert_splitwise_budget(sw)
+    assert_startup_budget(firefly)
+    assert firefly.calls["POST transactions"] <= FIREFLY_WRITES_PER_TRANSACTION * N
+    assert firefly.writes == firefly.calls["POST transactions"]
+    # Every expense was synced, so the budget is not met by skipping work
+    assert firefly.calls["POST transactions"] == N
+
+def test_budget_all_unchanged(main, user):
+    expenses = make_expenses()
+    firefly, sw = run_sync(main, user, expenses, make_groups(main, expenses), warm_comments=True)
+    assert_splitwise_budget(sw, comments_per_expense=0)
+    assert_startup_budget(firefly)
+    assert firefly.writes == 0
+
+def test_budget_old_edits(main, user):
+    expenses = make_expenses(created_days_ago=30)
+    groups = make_groups(main, expenses)
+    for group in groups:
+        group["attributes"]["transactions"][0]["amount"] = "9.0"
+    firefly, sw = run_sync(main, user, expenses, groups, in_window=False)
+    assert_splitwise_budget(sw)
+    assert firefly.calls["GET search"] >= N
+    assert_startup_budget(firefly, searches=FIREFLY_SEARCHES_PER_OLD_EXPENSE * N)
+    assert firefly.calls["PUT transactions"] <= FIREFLY_WRITES_PER_TRANSACTION * N
+    assert firefly.writes == firefly.calls["PUT transactions"]
+
+def test_budget_sw_balance(main, user):
+    with patch.dict('main.conf', {'SW_BALANCE_ACCOUNT': 'Splitwise balance'}):
+        firefly, sw = run_sync(main, user, make_expenses(paid="25.0"))
+    assert_splitwise_budget(sw)
+    # A split payment with its cover, and a balance transfer
+    assert firefly.calls["POST transactions"] <= 2 * FIREFLY_WRITES_PER_TRANSACTION * N
+    # The balancer revenue account is created once, not per expense
+    assert firefly.calls["POST accounts"] <= 1
+
+def test_budget_foreign_currency(main, user):
+    firefly, sw = run_sync(main, user, make_expenses(), currency="EUR")
+    assert_splitwise_budget(sw)
+    assert_startup_budget(firefly)
+    assert firefly.calls["POST transactions"] <= FIREFLY_WRITES_PER_TRANSACTION * N
+
+def test_budget_plan_apply(main, user, tmp_path):
+    path = str(tmp_path / "plan.jsonl")
+    expenses = make_expenses()
+    firefly, sw = run_sync(main, user, expenses, run=lambda sw, user: main.runPlan(sw, user, path))
+    assert_splitwise_budget(sw)
+    assert_startup_budget(firefly)
+    assert firefly.writes == 0
+    assert [op["op"] for op in main.PlanFile(path).load()] == ["add"] * N
+
+    firefly, sw = run_sync(main, user, expenses, run=lambda sw, user: main.runApply(path))
+    sw.getExpenses.assert_not_called()
+    assert firefly.calls["GET search"] == 0
+    assert firefly.calls["POST transactions"] == N
+    # Applied operations are removed from the plan
+    assert main.PlanFile(path).load() == []
+
+def test_budget_plan_old_edits(main, user, tmp_path):
+    path = str(tmp_path / "plan.jsonl")
+    expenses = make_expenses(created_days_ago=30)
+    groups = make_groups(main, expenses)
+    for group in groups:
+        group["attributes"]["transactions"][0]["amount"] = "9.0"
+    firefly, _ = run_sync(main, user, expenses, groups, in_window=False, run=lambda sw, user: main.runPlan(sw, user, path))
+    assert firefly.calls["GET search"] <= 1
+    ops = main.PlanFile(path).load()
+    assert [op["op"] for op in ops] == ["lookup"] * N
+    # The estimate matches the calls the live sync makes
+    assert sum(op["calls"] for op in ops) == (FIREFLY_SEARCHES_PER_OLD_EXPENSE + FIREFLY_WRITES_PER_TRANSACTION) * N
+
+    firefly, _ = run_sync(main, user, expenses, groups, in_window=False, run=lambda sw, user: main.runApply(path))
+    assert firefly.calls["GET search"] == FIREFLY_SEARCHES_PER_OLD_EXPENSE * N
+    assert firefly.calls["PUT transactions"] == N
+    assert firefly.writes == N
+
+def test_budget_plan_unchanged(main, user, tmp_path):
+    path = str(tmp_path / "plan.jsonl")
+    expenses = make_expenses()
+    firefly, _ = run_sync(main, user, expenses, make_groups(main, expenses), warm_comments=True,
+                          run=lambda sw, user: main.runPlan(sw, user, path))
+    assert [op["op"] for op in main.PlanFile(path).load()] == ["skip"] * N
+    firefly, _ = run_sync(main, user, expenses, run=lambda sw, user: main.runApply(path))
+    assert sum(firefly.calls.values()) == 0
+
+def test_budget_apply_interrupted(main, user, tmp_path):
+    path = str(tmp_path / "plan.jsonl")
+    expenses = make_expenses()
+    run_sync(main, user, expenses, run=lambda sw, user: main.runPlan(sw, user, path))
+
+    firefly = FakeFirefly([], [])
+    def interrupted(method, url, **kwargs):
+        if firefly.calls["POST transactions"] == 2:
+            raise KeyboardInterrupt
+        return firefly(method, url, **kwargs)
+    with patch('requests.request', interrupted), pytest.raises(KeyboardInterrupt):
+        main.runApply(path)
+    assert firefly.calls["POST transactions"] == 2
+
+    # The next apply resumes, nothing is sent twice
+    firefly, _ = run_sync(main, user, expenses, run=lambda sw, user: main.runApply(path))
+    assert firefly.calls["POST transactions"] == N - 2
+    assert main.PlanFile(path).load() == []
+
+def test_budget_apply_interrupted_updates(main, user, tmp_path):
+    path = str(tmp_path / "plan.jsonl")
+    expenses = make_expenses()
+    groups = make_groups(main, expenses)
+    for group in groups:
+        group["attributes"]["transactions"][0]["amount"] = "9.0"
+    run_sync(main, user, expenses, groups, run=lambda sw, user: main.runPlan(sw, user, path))
+    assert [op["op"] for op in main.PlanFile(path).load()] == ["update"] * N
+
+    firefly = FakeFirefly([], [])
+    def interrupted(method, url, **kwargs):
+        if firefly.calls["PUT transactions"] == 2:
+            raise KeyboardInterrupt
+        return firefly(method, url, **kwargs)
+    with patch('requests.request', interrupted), pytest.raises(KeyboardInterrupt):
+        main.runApply(path)
+    assert firefly.calls["PUT transactions"] == 2
+
+    # The applied updates are logged as planned, so they are not sent again
+    firefly, _ = run_sync(main, user, expenses, run=lambda sw, user: main.runApply(path))
+    assert firefly.calls["PUT transactions"] == N - 2
+    assert main.PlanFile(path).load() == []
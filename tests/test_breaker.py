@@ -0,0 +1,80 @@
+import threading
+import pytest
+from unittest.mock import patch
+import requests
+
+from breaker import CircuitOpenError, EndpointHealth, hedge
+
+
+def test_circuit_opens_and_recovers():
+    health = EndpointHealth("accounts", failure_threshold=2, cooldown=10)
+    with patch('breaker.time.monotonic', return_value=100):
+        health.record(1, False)
+        health.check()
+        health.record(1, False)
+        with pytest.raises(CircuitOpenError):
+            health.check()
+    with patch('breaker.time.monotonic', return_value=111):
+        # One trial call after the cooldown
+        health.check()
+        with pytest.raises(CircuitOpenError):
+            health.check()
+        health.record(1, True)
+        health.check()
+
+def test_circuit_success_resets_failures():
+    health = EndpointHealth("accounts", failure_threshold=2)
+    health.record(1, False)
+    health.record(1, True)
+    health.record(1, False)
+    health.check()
+
+def test_circuit_disabled():
+    health = EndpointHealth("accounts", failure_threshold=0)
+    for _ in range(10):
+        health.record(1, False)
+    health.check()
+
+def test_percentile():
+    health = EndpointHealth("search/transactions", min_samples=20)
+    for i in range(19):
+        health.record(i / 100, True)
+    assert health.percentile(95) is None
+    health.record(0.19, True)
+    assert health.percentile(95) == 0.19
+    assert health.percentile(50) == 0.10
+
+def test_hedge_fast_response_not_duplicated():
+    calls = []
+    def send():
+        calls.append(1)
+        return "first"
+    assert hedge(send, 1) == "first"
+    assert len(calls) == 1
+
+def test_hedge_slow_response_duplicated():
+    release = threading.Event()
+    responses = iter(["slow", "fast"])
+    lock = threading.Lock()
+    def send():
+        with lock:
+            res = next(responses)
+        if res == "slow":
+            release.wait(5)
+        return res
+    assert hedge(send, 0.01) == "fast"
+    release.set()
+
+def test_hedge_falls_back_to_other_request():
+    release = threading.Event()
+    attempts = iter([1, 2])
+    lock = threading.Lock()
+    def send():
+        with lock:
+            attempt = next(attempts)
+        if attempt == 1:
+            release.wait(5)
+            return "slow"
+        release.set()
+        raise requests.ConnectionError("reset")
+    assert hedge(send, 0.01) == "slow"
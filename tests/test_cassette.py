@@ -0,0 +1,38 @@
+import pytest
+from unittest.mock import patch
+import requests
+
+from cassette import Cassette
+
+def fake_send(session, request, **kwargs):
+    res = requests.Response()
+    res.status_code = 200
+    res.headers["Content-Type"] = "application/json"
+    res._content = f'{{"url": "{request.url}"}}'.encode()
+    res.request = request
+    return res
+
+def test_record_replay(tmp_path):
+    path = str(tmp_path / "run.jsonl.gz")
+    with patch('requests.Session.send', fake_send):
+        cassette = Cassette(path, "record").install()
+        assert requests.get("http://firefly/api/v1/accounts/?type=asset").json()["url"].endswith("type=asset")
+        requests.post("http://firefly/api/v1/transactions", json={"a": 1})
+        cassette.uninstall()
+        assert requests.Session.send is fake_send
+
+    cassette = Cassette(path, "replay", latency_scale=0).install()
+    try:
+        res = requests.get("http://firefly/api/v1/accounts/?type=asset")
+        assert res.status_code == 200
+        assert res.json()["url"].endswith("type=asset")
+        # Volatile query parameters fall back to the recorded exchange for the same path
+        assert requests.post("http://firefly/api/v1/transactions", json={"a": 2}).status_code == 200
+        with pytest.raises(requests.ConnectionError):
+            requests.get("http://firefly/api/v1/accounts/?type=asset")
+    finally:
+        cassette.uninstall()
+
+def test_invalid_mode(tmp_path):
+    with pytest.raises(ValueError):
+        Cassette(str(tmp_path / "run.jsonl.gz"), "rewind")
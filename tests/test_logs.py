@@ -0,0 +1,37 @@
+import io
+import json
+import logging
+import pytest
+from unittest.mock import Mock
+
+from logs import Lazy, setupLogging
+
+@pytest.fixture
+def restore_root_logger():
+    root = logging.getLogger()
+    handlers, level = root.handlers, root.level
+    yield
+    root.handlers, root.level = handlers, level
+
+def test_setupLogging_json(restore_root_logger):
+    stream = io.StringIO()
+    listener = setupLogging("info", "json", stream)
+    logging.getLogger("main").info("Added Transaction: %s", "Test", extra={"external_url": "url1"})
+    listener.stop()
+
+    entry = json.loads(stream.getvalue())
+    assert entry["level"] == "INFO"
+    assert entry["logger"] == "main"
+    assert entry["message"] == "Added Transaction: Test"
+    assert entry["external_url"] == "url1"
+
+def test_setupLogging_suppressed(restore_root_logger):
+    stream = io.StringIO()
+    listener = setupLogging("WARNING", "text", stream)
+    format_expense = Mock(return_value="Expense")
+    logging.getLogger("main").info("Processing %s", Lazy(format_expense))
+    logging.getLogger("main").warning("%s matches", Lazy(format_expense))
+    listener.stop()
+
+    assert stream.getvalue() == "Expense matches\n"
+    format_expense.assert_called_once()
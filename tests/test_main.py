@@ -5,6 +5,9 @@ from splitwise.user import ExpenseUser
 from unittest.mock import MagicMock, patch
 import requests
 import importlib
+import json
+
+from breaker import CircuitOpenError
 
 @pytest.fixture(autouse=True)
 def mock_requests():
@@ -98,6 +101,119 @@ def test_callApi(mock_request):
     assert result.json() == {"data": "test"}
     mock_request.assert_called_once()
 
+def test_callApi_conditional_get(mock_requests, tmp_path):
+    main = load_main()
+    cached = requests.Response()
+    cached.status_code, cached._content = 200, b'{"data": ["cached"]}'
+    cached.headers["ETag"] = '"v1"'
+    not_modified = requests.Response()
+    not_modified.status_code, not_modified._content = 304, b""
+    mock_requests.side_effect = [cached, not_modified]
+
+    with patch('main.response_cache', main.ResponseCache(str(tmp_path))):
+        assert main.callApi("accounts/", method="GET", params={"type": "asset"}).json() == {"data": ["cached"]}
+        assert main.callApi("accounts/", method="GET", params={"type": "asset"}).json() == {"data": ["cached"]}
+    assert mock_requests.call_args.kwargs["headers"]["If-None-Match"] == '"v1"'
+
+def test_callApi_cache_ttl(mock_requests, tmp_path):
+    main = load_main()
+    res = requests.Response()
+    res.status_code, res._content = 200, b'{"data": []}'
+    mock_requests.side_effect = [res]
+
+    with patch('main.response_cache', main.ResponseCache(str(tmp_path), ttl=60)):
+        main.callApi("accounts/", method="GET")
+        assert main.callApi("accounts/", method="GET").json() == {"data": []}
+    mock_requests.assert_called_once()
+
+def test_callApi_cache_per_token(mock_requests, tmp_path):
+    main = load_main()
+    res = requests.Response()
+    res.status_code, res._content = 200, b'{"data": ["first"]}'
+    other = requests.Response()
+    other.status_code, other._content = 200, b'{"data": ["other"]}'
+    mock_requests.side_effect = [res, other]
+
+    with patch('main.response_cache', main.ResponseCache(str(tmp_path), ttl=60, scope="token1")):
+        main.callApi("accounts/", method="GET")
+    with patch('main.response_cache', main.ResponseCache(str(tmp_path), ttl=60, scope="token2")):
+        assert main.callApi("accounts/", method="GET").json() == {"data": ["other"]}
+    assert mock_requests.call_count == 2
+
+def test_addTransaction_spool(mock_requests, tmp_path):
+    main = load_main()
+    spool = main.WriteSpool(str(tmp_path / "spool.jsonl"))
+    ok = requests.Response()
+    ok.status_code, ok._content = 200, b'{"data": {"id": "1"}}'
+    mock_requests.side_effect = [requests.ConnectionError("down"), requests.Timeout("slow"), ok]
+
+    with patch('main.write_spool', spool), patch.dict('main.conf', {'FIREFLY_DRY_RUN': False}):
+        assert main.addTransaction({"description": "Test"}) is None
+        assert [e["path"] for e in spool.load()] == ["transactions"]
+        # Firefly still down, spool kept
+        assert main.flushSpool() == 0
+        assert len(spool.load()) == 1
+        assert main.flushSpool() == 1
+        assert spool.load() == []
+    assert mock_requests.call_args.kwargs["json"]["group_title"] == "Test"
+
+def test_callApi_circuit_breaker(mock_requests, tmp_path):
+    main = load_main()
+    spool = main.WriteSpool(str(tmp_path / "spool.jsonl"))
+    mock_requests.side_effect = requests.Timeout("slow")
+
+    with patch.dict('main.endpoint_health', clear=True), \
+         patch.dict('main.conf', {'FIREFLY_DRY_RUN': False, 'FIREFLY_BREAKER_THRESHOLD': 2}):
+        for _ in range(2):
+            with pytest.raises(requests.Timeout):
+                main.callApi("transactions/1", method="PUT")
+        # Fails fast for every ID of the endpoint, other endpoints are still called
+        with pytest.raises(CircuitOpenError):
+            main.callApi("transactions/2", method="PUT")
+        with pytest.raises(requests.Timeout):
+            main.callApi("accounts", method="GET")
+        assert mock_requests.call_count == 3
+        # An open circuit spools writes like an unreachable Firefly
+        with patch('main.write_spool', spool):
+            assert main.addTransaction({"description": "Test"}) is None
+        assert mock_requests.call_count == 3
+    assert len(spool.load()) == 1
+
+def test_callApi_circuit_trial_other_error(mock_requests):
+    main = load_main()
+    with patch.dict('main.endpoint_health', clear=True), \
+         patch.dict('main.conf', {'FIREFLY_BREAKER_THRESHOLD': 1, 'FIREFLY_BREAKER_COOLDOWN': 0}):
+        mock_requests.side_effect = requests.ConnectionError("down")
+        with pytest.raises(requests.ConnectionError):
+            main.callApi("accounts", method="GET")
+        # The trial call fails before reaching Firefly, e.g. on an unserializable body
+        mock_requests.side_effect = TypeError("not serializable")
+        with pytest.raises(TypeError):
+            main.callApi("accounts", method="GET")
+        mock_requests.side_effect = None
+        main.callApi("accounts", method="GET")
+    assert mock_requests.call_count == 3
+
+def test_callApi_default_timeout(mock_requests):
+    main = load_main()
+    with patch.dict('main.conf', {'FIREFLY_TIMEOUT': 60}):
+        main.callApi("accounts", method="GET")
+        assert mock_requests.call_args.kwargs["timeout"] == 60
+        main.callApi("accounts", method="GET", timeout=5)
+        assert mock_requests.call_args.kwargs["timeout"] == 5
+
+def test_addTransaction_spool_client_error(mock_requests, tmp_path):
+    main = load_main()
+    spool = main.WriteSpool(str(tmp_path / "spool.jsonl"))
+    bad = requests.Response()
+    bad.status_code, bad._content = 422, b'{}'
+    mock_requests.return_value = bad
+
+    with patch('main.write_spool', spool), patch.dict('main.conf', {'FIREFLY_DRY_RUN': False}):
+        with pytest.raises(requests.HTTPError):
+            main.addTransaction({"description": "Test"})
+    assert spool.load() == []
+
 @patch('main.callApi')
 def test_searchTransactions(mock_callApi):
     searchTransactions = load_main().searchTransactions
@@ -114,6 +230,26 @@ def test_searchTransactions(mock_callApi):
     assert [r["id"] for r in result] == ["1", "2", "3"]
     assert mock_callApi.call_count == 3
 
+@patch('main.callApi')
+def test_searchTransactions_pagination_meta(mock_callApi):
+    searchTransactions = load_main().searchTransactions
+    def mock_response(path, method, params):
+        return MagicMock(json=lambda: {
+            "data": [{"id": str(params["page"])}],
+            "meta": {"pagination": {"total_pages": 3}},
+        })
+    mock_callApi.side_effect = mock_response
+
+    result = searchTransactions({"query": "test"})
+    assert [r["id"] for r in result] == ["1", "2", "3"]
+    # No request for the empty page after the last one
+    assert mock_callApi.call_count == 3
+    assert sorted(c.args[2]["page"] for c in mock_callApi.call_args_list) == [1, 2, 3]
+
+    # Pages are still fetched with no search workers configured
+    with patch.dict('main.conf', {'FIREFLY_SEARCH_WORKERS': 0}):
+        assert [r["id"] for r in searchTransactions({"query": "test"})] == ["1", "2", "3"]
+
 @patch('main.searchTransactions')
 def test_getTransactionsAfter(mock_searchTransactions):
     getTransactionsAfter = load_main().getTransactionsAfter
@@ -127,6 +263,41 @@ def test_getTransactionsAfter(mock_searchTransactions):
     assert "url1" in result
     assert "url2" in result
 
+def test_projectTransactionGroup():
+    projectTransactionGroup = load_main().projectTransactionGroup
+    txn = {
+        "id": "123",
+        "type": "transactions",
+        "attributes": {
+            "group_title": None,
+            "user": "1",
+            "transactions": [{
+                "transaction_journal_id": "456",
+                "description": "Desc",
+                "amount": "10.000000000000",
+                "source_id": "7",
+                "source_name": "Amex",
+                "foreign_currency_id": None,
+                "budget_name": None,
+                "tags": [],
+            }],
+        },
+    }
+    result = projectTransactionGroup(txn)
+    assert result == {
+        "id": "123",
+        "attributes": {
+            "group_title": None,
+            "transactions": [{
+                "transaction_journal_id": "456",
+                "description": "Desc",
+                "amount": "10.000000000000",
+                "source_name": "Amex",
+                "tags": [],
+            }],
+        },
+    }
+
 @patch('main.getAccountCurrencyCode')
 def test_getExpenseTransactionBody(mock_getAccountCurrencyCode, mock_expense, mock_expense_user):
     getExpenseTransactionBody = load_main().getExpenseTransactionBody
@@ -190,6 +361,59 @@ def test_processExpense_add_new(
     mock_updateTransaction.assert_not_called()
     mock_searchTransactions.assert_called_once()
 
+def test_getTransactionHash():
+    getTransactionHash = load_main().getTransactionHash
+    new_txn = {
+        "type": "withdrawal",
+        "description": "Desc",
+        "source_name": "Amex",
+        "destination_name": "Dest",
+        "amount": "10.0",
+        "date": "2023-09-10T12:00:00+00:00",
+        "category_name": "Category",
+        "notes": "",
+        "external_url": "https://secure.splitwise.com/expenses/1",
+    }
+    old_txn = dict(new_txn, amount="10.000000000000", date="2023-09-10T14:00:00+02:00", notes=None)
+    assert getTransactionHash(new_txn) == getTransactionHash([old_txn])
+    assert getTransactionHash(new_txn) != getTransactionHash(dict(new_txn, amount="11.0"))
+    assert getTransactionHash(new_txn) != getTransactionHash(dict(new_txn, category_name="Other"))
+    # Same fields, different Splitwise expense: Firefly accepts both
+    assert getTransactionHash(new_txn) != getTransactionHash(dict(new_txn, external_url="https://secure.splitwise.com/expenses/2"))
+
+@patch('main.updateTransaction')
+@patch('main.addTransaction')
+@patch('main.searchTransactions')
+@patch('main.getAccountCurrencyCode')
+def test_processExpense_duplicate_hash(mock_getAccountCurrencyCode,
+                                       mock_searchTransactions,
+                                       mock_addTransaction,
+                                       mock_updateTransaction,
+                                       mock_expense,
+                                       mock_expense_user):
+    main = load_main()
+    mock_getAccountCurrencyCode.return_value = "USD"
+    mock_searchTransactions.return_value = []
+    mock_addTransaction.side_effect = lambda txn: {"id": "1", "attributes": {"transactions": [txn]}}
+    other_expense = MagicMock(spec=Expense)
+    for name in ["getDescription", "getCurrencyCode", "getDate", "getCreatedAt", "getDetails", "getDeletedAt",
+                 "getPayment", "getUpdatedBy", "getCreatedBy"]:
+        getattr(other_expense, name).return_value = getattr(mock_expense, name).return_value
+    other_expense.getId.return_value = "67891"
+
+    past_day = datetime.now().astimezone() - timedelta(days=1)
+    args = [mock_expense_user, ["Dest", "Category", "Desc"]]
+    with patch.dict('main.conf', {'SW_BALANCE_ACCOUNT': ''}), patch.dict('main.txn_hashes', clear=True):
+        main.processExpense(past_day, {}, mock_expense, *args)
+        # Same fields but another expense, not a duplicate
+        main.processExpense(past_day, {}, other_expense, *args)
+        # The same expense again, e.g. from the remainder and the feed
+        main.processExpense(past_day, {}, mock_expense, *args)
+    assert [c.args[0]["external_url"] for c in mock_addTransaction.call_args_list] == [
+        "https://secure.splitwise.com/expenses/67890", "https://secure.splitwise.com/expenses/67891",
+    ]
+    mock_updateTransaction.assert_not_called()
+
 @pytest.fixture
 def mock_splitwise():
     return MagicMock()
@@ -286,5 +510,213 @@ def test_getExpensesAfter(mock_splitwise, mock_user):
     # Verify that the third expense (without Firefly data) was not returned
     assert all(r[0].getId() != "3" for r in result), "Expense without Firefly data should not be returned"
 
+def test_fetchExpensesSharded(mock_splitwise):
+    main = load_main()
+    date = datetime.now() - timedelta(days=7)
+    mock_splitwise.getGroups.return_value = [MagicMock(getId=MagicMock(return_value=gid)) for gid in [0, 10, 20]]
+    shared = MagicMock(getId=MagicMock(return_value=1))
+    shard_expenses = {
+        0: [MagicMock(getId=MagicMock(return_value=2))],
+        10: [shared, MagicMock(getId=MagicMock(return_value=3))],
+        20: [shared],
+    }
+    def getExpenses(offset, limit, group_id, updated_after):
+        assert updated_after == date.isoformat()
+        return shard_expenses[group_id] if offset == 0 else []
+    mock_splitwise.getExpenses.side_effect = getExpenses
+
+    with patch.dict('main.conf', {'SPLITWISE_SHARD_WORKERS': 3}):
+        result = main.fetchExpensesSharded(mock_splitwise, updated_after=date.isoformat())
+    assert sorted(e.getId() for e in result) == [1, 2, 3]
+    assert mock_splitwise.getExpenses.call_count == 6
+
+@patch('main.getActualTransactions')
+@patch('main.getExpectedTransactions')
+def test_auditTransactions(mock_getExpectedTransactions, mock_getActualTransactions, mock_splitwise, mock_user):
+    main = load_main()
+    def body(url, amount="10.0"):
+        return {"description": url, "amount": amount, "external_url": url}
+    def group(id, url, amount="10.0"):
+        return {"id": id, "attributes": {"transactions": [body(url, amount)]}}
+
+    # Windows: "edge" is on Splitwise in window 1 and on Firefly in window 2
+    mock_getExpectedTransactions.side_effect = [
+        ({"ok": body("ok"), "edge": body("edge"), "drift": body("drift"), "dup": body("dup")}, set(), {}),
+        ({"missing": body("missing")}, {"deleted"}, {"broken": "Account Old not found in asset accounts."}),
+    ]
+    mock_getActualTransactions.side_effect = [
+        {"ok": [group("1", "ok")], "drift": [group("2", "drift", "11.0")], "dup": [group("3", "dup"), group("4", "dup")]},
+        {"edge": [group("5", "edge")], "orphan": [group("6", "orphan")], "deleted-balance_transfer-1": [group("7", "deleted")],
+         "broken": [group("8", "broken")]},
+    ]
+    since = datetime(2023, 1, 1).astimezone()
+    findings = list(main.auditTransactions(mock_splitwise, mock_user, since, since + timedelta(days=20), 10))
+
+    assert sorted((f["kind"], f["external_url"]) for f in findings) == [
+        ("drifted", "drift"), ("duplicated", "dup"), ("failed", "broken"), ("missing", "missing"),
+        ("orphaned", "deleted-balance_transfer-1"), ("orphaned", "orphan"),
+    ]
+    # Only expenses deleted on Splitwise are deleted on Firefly
+    orphans = {f["external_url"]: main.getFixOperations(f) for f in findings if f["kind"] == "orphaned"}
+    assert orphans == {"orphan": [], "deleted-balance_transfer-1": [{"op": "delete", "external_url": "deleted-balance_transfer-1", "id": "7"}]}
+    assert main.getFixOperations(next(f for f in findings if f["kind"] == "failed")) == []
+    drifted = next(f for f in findings if f["kind"] == "drifted")
+    assert drifted["diff"] == ["amount"]
+    assert main.getFixOperations(drifted) == [{"op": "update", "external_url": "drift", "id": "2", "body": body("drift")}]
+    duplicated = next(f for f in findings if f["kind"] == "duplicated")
+    assert main.getFixOperations(duplicated) == [{"op": "delete", "external_url": "dup", "id": "4"}]
+    # Only the last window searches Firefly up to and including its end day
+    assert [c.kwargs["include_end"] for c in mock_getActualTransactions.call_args_list] == [False, True]
+
+def test_getTransactionDiff_firefly_shape():
+    main = load_main()
+    body = [
+        {"description": "Lunch", "amount": "10.0", "foreign_amount": "10.0", "notes": "", "category_name": "Food", "tags": []},
+        {"description": "Cover for: Lunch", "amount": "5.0", "notes": "", "category_name": ""},
+    ]
+    group = {"id": "1", "attributes": {"transactions": [
+        {"description": "Lunch", "amount": "10.000000000000", "foreign_amount": "10.000000000000", "notes": None,
+         "category_name": "Food", "tags": None},
+        {"description": "Cover for: Lunch", "amount": "5.000000000000", "notes": None, "category_name": None},
+    ]}}
+    assert main.getTransactionDiff(body, group) == []
+    assert main.getTransactionHash(body) == main.getTransactionHash(group["attributes"]["transactions"])
+    body[0]["foreign_amount"] = "11.0"
+    body[1]["notes"] = "Shared"
+    assert main.getTransactionDiff(body, group) == ["foreign_amount", "notes"]
+
+@patch('main.searchTransactions')
+def test_getActualTransactions_days(mock_searchTransactions):
+    main = load_main()
+    mock_searchTransactions.return_value = []
+    start, end = datetime(2023, 1, 1, 12).astimezone(), datetime(2023, 1, 11, 12).astimezone()
+    main.getActualTransactions(start, end)
+    assert 'payment_date_after:"2023-01-01" payment_date_before:"2023-01-10"' in mock_searchTransactions.call_args[0][0]["query"]
+    main.getActualTransactions(start, end, include_end=True)
+    assert 'payment_date_before:"2023-01-11"' in mock_searchTransactions.call_args[0][0]["query"]
+
+@patch('main.getExpenseTransactions')
+@patch('main.selectExpenses')
+@patch('main.fetchExpenses')
+def test_getExpectedTransactions_evicts_comments(mock_fetchExpenses, mock_selectExpenses, mock_getExpenseTransactions, mock_splitwise, mock_user):
+    main = load_main()
+    expenses = [MagicMock(getId=MagicMock(return_value=i)) for i in range(3)]
+    mock_fetchExpenses.return_value = expenses
+    def select(sw, expenses, user):
+        for exp in expenses:
+            main.comment_cache[str(exp.getId())] = {"stamp": [], "data": []}
+            yield exp, None, []
+    mock_selectExpenses.side_effect = select
+    def transactions(exp, *args):
+        if exp.getId() == 2:
+            raise ValueError("Account Old not found in asset accounts.")
+        return exp, [{"external_url": str(exp.getId())}]
+    mock_getExpenseTransactions.side_effect = transactions
+
+    with patch.dict('main.comment_cache', {"0": {"stamp": [], "data": []}}, clear=True), \
+         patch.dict('main.conf', {'SPLITWISE_SHARD_WORKERS': 0}):
+        start = datetime(2023, 1, 1).astimezone()
+        expected, deleted, failed = main.getExpectedTransactions(mock_splitwise, mock_user, start, start + timedelta(days=10))
+        assert list(expected) == ["0", "1"]
+        # A failing expense does not abort the audit
+        assert list(failed.values()) == ["Account Old not found in asset accounts."]
+        # Loaded from the persistent cache, kept
+        assert list(main.comment_cache) == ["0"]
+
+def test_runApply_fix_plan(mock_requests, tmp_path):
+    main = load_main()
+    path = str(tmp_path / "fix.jsonl")
+    plan = main.PlanFile(path)
+    body = {"description": "drift", "amount": "10.0", "external_url": "drift"}
+    plan.write([
+        {"op": "update", "external_url": "drift", "id": "2", "body": body},
+        {"op": "delete", "external_url": "dup", "id": "4"},
+    ])
+    group = requests.Response()
+    group.status_code, group._content = 200, json.dumps({"data": {"id": "2", "attributes": {"transactions": [{**body, "amount": "11.0"}]}}}).encode()
+    updated = requests.Response()
+    updated.status_code, updated._content = 200, b'{"data": {}}'
+    gone = requests.Response()
+    gone.status_code = 404
+
+    def request(method, url, **kwargs):
+        return {"GET": group, "PUT": updated, "DELETE": gone}[method]
+    mock_requests.side_effect = request
+
+    with patch.dict('main.conf', {'FIREFLY_DRY_RUN': False, 'SYNC_WRITE_WORKERS': 0}), patch('main.write_spool', None):
+        assert main.runApply(path) == {"applied": 1, "failed": 1}
+    # The update fetched the group it was planned without
+    assert [c.args[0] for c in mock_requests.call_args_list].count("GET") == 1
+    # The failed delete is kept for the next apply
+    assert plan.load() == [{"op": "delete", "external_url": "dup", "id": "4"}]
+
+def test_getExpensesAfter_budget(mock_splitwise, mock_user, mock_expense_user):
+    main = load_main()
+    def expense(id, updated_at):
+        exp = MagicMock(spec=Expense)
+        exp.getId.return_value = id
+        exp.getUpdatedAt.return_value = updated_at
+        exp.getDeletedAt.return_value = None
+        exp.getPayment.return_value = False
+        exp.getUsers.return_value = [mock_expense_user]
+        exp.getDescription.return_value = f"Expense {id}"
+        exp.getDetails.return_value = "firefly"
+        exp.getUpdatedBy.return_value = None
+        exp.getCreatedBy.return_value = MagicMock(getId=MagicMock(return_value="12345"))
+        return exp
+    old, new, left_over = expense(1, "2023-09-10T12:00:00Z"), expense(2, "2023-09-11T12:00:00Z"), expense(3, "2023-09-01T12:00:00Z")
+    mock_splitwise.getExpenses.side_effect = [[old, new], []]
+    mock_splitwise.getExpense.return_value = left_over
+    mock_splitwise.getComments.return_value = []
+
+    with patch.dict('main.conf', {'SYNC_BUDGET_SECONDS': 60}), \
+         patch('main.sync_remainder', set()), patch('main.sync_deadline', None):
+        result = main.getExpensesAfter(mock_splitwise, datetime.now() - timedelta(days=1), mock_user, [3])
+        # Most recently updated first
+        assert next(result)[0] is new
+        with patch('main.sync_deadline', 0):
+            assert list(result) == []
+            assert main.sync_remainder == {1, 3}
+            main.writeExpenseTransactions(datetime.now().astimezone(), {}, new, [{}])
+            assert main.sync_remainder == {1, 2, 3}
+    mock_splitwise.getExpense.assert_called_once_with(3)
+
+def test_remainder_roundtrip(tmp_path):
+    main = load_main()
+    path = str(tmp_path / "remainder.json")
+    assert main.loadRemainder(path) == []
+    main.saveRemainder(path, {3, 1})
+    assert main.loadRemainder(path) == [1, 3]
+
+def test_getCommentData_cache(mock_splitwise, mock_user, mock_expense):
+    main = load_main()
+    mock_expense.getId.return_value = "cached-67890"
+    mock_expense.getUpdatedAt.return_value = "2023-09-10T12:00:00Z"
+    mock_expense.getCommentsCount.return_value = 1
+    mock_comment = MagicMock(spec=Comment)
+    mock_comment.getCommentedUser.return_value = MagicMock(getId=MagicMock(return_value="12345"))
+    mock_comment.getContent.return_value = "firefly/Dest"
+    mock_splitwise.getComments.return_value = [mock_comment]
+
+    with patch.dict('main.comment_cache', clear=True):
+        assert main.getCommentData(mock_splitwise, mock_expense, mock_user) == ["Dest"]
+        # Unchanged expense is served from the cache
+        assert main.getCommentData(mock_splitwise, mock_expense, mock_user) == ["Dest"]
+        assert mock_splitwise.getComments.call_count == 1
+
+        # New comment invalidates the cache
+        mock_expense.getCommentsCount.return_value = 2
+        main.getCommentData(mock_splitwise, mock_expense, mock_user)
+        assert mock_splitwise.getComments.call_count == 2
+
+def test_commentCache_roundtrip(tmp_path):
+    main = load_main()
+    path = str(tmp_path / "comments.json")
+    assert main.loadCommentCache(path) == {}
+    cache = {"1": {"stamp": ["2023-09-10T12:00:00Z", 0], "data": ["Dest"]}}
+    main.saveCommentCache(path, cache)
+    assert main.loadCommentCache(path) == cache
+    assert main.loadCommentCache("") == {}
+
 if __name__ == "__main__":
     pytest.main([__file__])
\ No newline at end of file
@@ -0,0 +1,43 @@
+import pytest
+import threading
+import time
+
+from pipeline import Pipeline
+
+def test_pipeline_order():
+    out = []
+    Pipeline(2).stage(lambda x: x * 2).stage(out.append).run(range(10))
+    assert out == [x * 2 for x in range(10)]
+
+def test_pipeline_workers_drop_none():
+    out = []
+    lock = threading.Lock()
+    def collect(x):
+        with lock:
+            out.append(x)
+    Pipeline(2) \
+        .stage(lambda x: x if x % 2 else None, workers=3) \
+        .stage(collect, workers=2) \
+        .run(range(20))
+    assert sorted(out) == list(range(1, 20, 2))
+
+def test_pipeline_backpressure():
+    produced = []
+    def source():
+        for i in range(10):
+            produced.append(i)
+            yield i
+    def slow(x):
+        time.sleep(0.05)
+        # Source can only be ahead by what fits in the queues and the workers
+        assert len(produced) - x <= 5
+    Pipeline(1).stage(lambda x: x).stage(slow).run(source())
+    assert len(produced) == 10
+
+def test_pipeline_error():
+    def fail(x):
+        if x == 3:
+            raise ValueError("boom")
+        return x
+    with pytest.raises(ValueError, match="boom"):
+        Pipeline(1).stage(fail).stage(lambda x: None).run(range(100))
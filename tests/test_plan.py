@@ -0,0 +1,26 @@
+from plan import PlanFile
+
+
+def test_plan_resume(tmp_path):
+    path = str(tmp_path / "plan.jsonl")
+    ops = [{"op": "add", "external_url": str(i), "body": {"amount": "1.0"}, "calls": 1} for i in range(3)]
+    plan = PlanFile(path)
+    plan.write(ops)
+    assert plan.load() == ops
+
+    plan.applied(ops[1])
+    # Another process, e.g. the next apply after a crash
+    assert PlanFile(path).load() == [ops[0], ops[2]]
+
+    plan.write([ops[0]])
+    assert plan.load() == [ops[0]]
+    assert not (tmp_path / "plan.jsonl.applied").exists()
+
+def test_plan_empty(tmp_path):
+    path = str(tmp_path / "plan.jsonl")
+    plan = PlanFile(path)
+    assert plan.load() == []
+    plan.write([{"op": "add"}])
+    plan.write([])
+    assert not (tmp_path / "plan.jsonl").exists()
+    assert plan.load() == []
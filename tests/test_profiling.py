@@ -0,0 +1,64 @@
+import os
+import pstats
+import pytest
+import threading
+import tracemalloc
+
+from profiling import CONCURRENT_PROFILES, Profiler
+
+def allocate(n):
+    return [str(i) for i in range(n)]
+
+def test_profiler_stages(tmp_path):
+    profiler = Profiler(str(tmp_path)).start()
+    fetch = profiler.wrap("fetch", allocate)
+    write = profiler.wrap("write", lambda: fetch(10))
+
+    assert len(fetch(1000)) == 1000
+    threads = [threading.Thread(target=fetch, args=(100,)) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    write()
+    profiler.report()
+
+    assert sorted(os.listdir(tmp_path)) == ["fetch.alloc.txt", "fetch.pstats", "write.alloc.txt", "write.pstats"]
+    stats = pstats.Stats(str(tmp_path / "fetch.pstats"))
+    # The nested call from write is attributed to the write stage
+    assert any(func[2] == "allocate" and stat[0] == 5 for func, stat in stats.stats.items())
+    assert "test_profiling.py" in (tmp_path / "fetch.alloc.txt").read_text()
+
+def test_profiler_sampling(tmp_path):
+    profiler = Profiler(str(tmp_path), sample_rate=0).start()
+    assert profiler.wrap("fetch", allocate)(10) == allocate(10)
+    profiler.report()
+    assert os.listdir(tmp_path) == ["fetch.alloc.txt"]
+
+def test_profiler_traces_only_sampled_calls(tmp_path):
+    profiler = Profiler(str(tmp_path), sample_rate=0).start()
+    assert profiler.wrap("fetch", tracemalloc.is_tracing)() is False
+    profiler = Profiler(str(tmp_path)).start()
+    assert profiler.wrap("fetch", tracemalloc.is_tracing)() is True
+    assert not tracemalloc.is_tracing()
+
+@pytest.mark.skipif(not CONCURRENT_PROFILES, reason="cProfile is serialized on this Python version")
+def test_profiler_concurrent_threads(tmp_path):
+    profiler = Profiler(str(tmp_path)).start()
+    barrier = threading.Barrier(2, timeout=5)
+    # Deadlocks, then breaks the barrier, if sampled calls were serialized
+    fetch = profiler.wrap("fetch", lambda: barrier.wait())
+    errors = []
+    def run():
+        try:
+            fetch()
+        except threading.BrokenBarrierError as e:
+            errors.append(e)
+    threads = [threading.Thread(target=run) for _ in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+    profiler.report()
+    assert "fetch.pstats" in os.listdir(tmp_path)
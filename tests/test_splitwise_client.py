@@ -0,0 +1,49 @@
+import json
+import pytest
+from unittest.mock import patch
+import requests
+from splitwise.exception import SplitwiseNotFoundException
+
+from splitwise_client import PooledSplitwise
+
+USER = {"id": 12345, "first_name": "Test", "last_name": "User", "email": "test@example.com",
+        "default_currency": "USD", "locale": "en", "date_format": "MM/DD/YYYY", "default_group_id": None}
+
+def response(status, content):
+    res = requests.Response()
+    res.status_code, res._content = status, json.dumps(content).encode()
+    return res
+
+def test_pooled_session():
+    sw = PooledSplitwise("", "", api_key="key", pool_size=8, timeout=5)
+    with patch.object(sw._session, 'send', return_value=response(200, {"user": USER})) as mock_send:
+        assert sw.getCurrentUser().getFirstName() == "Test"
+        assert sw.getCurrentUser().getId() == 12345
+    assert mock_send.call_count == 2
+    prep, kwargs = mock_send.call_args.args[0], mock_send.call_args.kwargs
+    assert prep.headers["Authorization"] == "Bearer key"
+    assert kwargs["timeout"] == 5
+    adapter = sw._session.get_adapter("https://secure.splitwise.com")
+    assert adapter._pool_maxsize == 8
+    assert adapter.max_retries.total == 3
+    assert 503 in adapter.max_retries.status_forcelist
+
+def test_errors():
+    sw = PooledSplitwise("", "", api_key="key")
+    with patch.object(sw._session, 'send', return_value=response(404, {})):
+        with pytest.raises(SplitwiseNotFoundException):
+            sw.getExpense(1)
+
+def test_current_user_cache(tmp_path):
+    path = str(tmp_path / "user.json")
+    sw = PooledSplitwise("", "", api_key="key", user_cache=path)
+    with patch.object(sw._session, 'send', return_value=response(200, {"user": USER})) as mock_send:
+        sw.getCurrentUser()
+        assert PooledSplitwise("", "", api_key="key", user_cache=path).getCurrentUser().getFirstName() == "Test"
+        assert mock_send.call_count == 1
+
+    # A different token does not use the cached user
+    other = PooledSplitwise("", "", api_key="other", user_cache=path)
+    with patch.object(other._session, 'send', return_value=response(200, {"user": USER})) as mock_send:
+        other.getCurrentUser()
+        assert mock_send.call_count == 1